@@ -0,0 +1,50 @@
+"""
+Benchmarks write_files (one parsed name at a time) against write_files_columnar
+(NumPy string columns) and checks that both write the same files.
+
+Usage: python -m benchmarks.bench_columnar [--counts 100000 1000000]
+"""
+
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+
+import linkedin2username
+from benchmarks.corpus import make_names
+
+
+def run(label, write, employees, out_dir):
+    """Writes the files for every employee and prints the throughput."""
+    linkedin2username.parse_name.cache_clear()
+    linkedin2username.DEFAULT_FORMATS.mutate.cache_clear()
+
+    start = time.perf_counter()
+    write('bench', '@example.com', employees, out_dir)
+    elapsed = time.perf_counter() - start
+    print(f"{len(employees):>9,} {label:<10} {len(employees) / elapsed:>12,.0f} names/sec  ({elapsed:.2f}s)")
+
+
+def main():
+    """Main Function"""
+    parser = argparse.ArgumentParser(description='Columnar mutation benchmark')
+    parser.add_argument('--counts', type=int, nargs='+', default=[100000, 1000000],
+                        help='Corpus sizes to run. Defaults to 100000 and 1000000.')
+    args = parser.parse_args()
+
+    for count in args.counts:
+        employees = [linkedin2username.Employee(name, 'Engineer') for name in make_names(count)]
+        with tempfile.TemporaryDirectory() as out_dir:
+            objects_dir = os.path.join(out_dir, 'objects')
+            columns_dir = os.path.join(out_dir, 'columns')
+            run('objects', linkedin2username.write_files, employees, objects_dir)
+            run('columnar', linkedin2username.write_files_columnar, employees, columns_dir)
+
+            for name in os.listdir(objects_dir):
+                assert filecmp.cmp(os.path.join(objects_dir, name),
+                                   os.path.join(columns_dir, name), shallow=False), name
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmarks name normalization (NameMutator.clean_name + split_name).
+
+The legacy functions below are the per-call regex chain that clean_name and
+split_name used before the patterns were compiled at import time. They are
+kept here so both can be measured on the same corpus.
+
+Usage: python -m benchmarks.bench_names [--count 1000000]
+"""
+
+import argparse
+import re
+import time
+
+from linkedin2username import NameMutator
+from benchmarks.corpus import make_names
+
+
+def legacy_clean_name(name):
+    """clean_name as it was: one re.sub per stage, patterns built per call."""
+    name = name.lower()
+    name = re.sub("[àáâãäå]", 'a', name)
+    name = re.sub("[èéêë]", 'e', name)
+    name = re.sub("[ìíîï]", 'i', name)
+    name = re.sub("[òóôõö]", 'o', name)
+    name = re.sub("[ùúûü]", 'u', name)
+    name = re.sub("[ýÿ]", 'y', name)
+    name = re.sub("[ß]", 'ss', name)
+    name = re.sub("[ñ]", 'n', name)
+    name = re.sub(r'\([^()]*\)', '', name)
+    allowed_chars = re.compile('[^a-zA-Z -]')
+    name = allowed_chars.sub('', name)
+    titles = ['mr', 'miss', 'mrs', 'phd', 'prof', 'professor', 'md', 'dr', 'mba']
+    pattern = "\\b(" + "|".join(titles) + ")\\b"
+    name = re.sub(pattern, '', name)
+    name = re.sub(r'\s+', ' ', name).strip()
+    return name
+
+
+def legacy_split_name(name):
+    """split_name as it was: re.split followed by a filtering pass."""
+    parsed = re.split(r'[\s-]+', name)
+    parsed = [part for part in parsed if part]
+    if len(parsed) < 2:
+        return None
+    if len(parsed) > 2:
+        return {'first': parsed[0], 'second': parsed[-2], 'last': parsed[-1]}
+    return {'first': parsed[0], 'second': '', 'last': parsed[-1]}
+
+
+def run(label, clean, split, names):
+    """Normalizes every name and prints the throughput."""
+    start = time.perf_counter()
+    for name in names:
+        split(clean(name))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {len(names) / elapsed:>12,.0f} names/sec  ({elapsed:.2f}s)")
+    return elapsed
+
+
+def main():
+    """Main Function"""
+    parser = argparse.ArgumentParser(description='Name normalization benchmark')
+    parser.add_argument('--count', type=int, default=1000000,
+                        help='Number of names in the corpus. Defaults to 1000000.')
+    args = parser.parse_args()
+
+    names = make_names(args.count)
+
+    # Both implementations must agree before their speed means anything.
+    for name in names[:10000]:
+        assert NameMutator.clean_name(name) == legacy_clean_name(name), name
+
+    before = run('before', legacy_clean_name, legacy_split_name, names)
+    after = run('after', NameMutator.clean_name, NameMutator.split_name, names)
+    print(f"speedup    {before / after:>12.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmarks parsing a page of search results (parse_results).
+
+The legacy function below is what do_loops and find_employees did before: scan
+the whole reply for the search limit, then decode it with the standard library
+json module. It is measured against parse_results with each JSON backend that
+is installed, on tests/mock-employee-response and on a full synthetic page.
+
+Usage: python -m benchmarks.bench_parse [--count 2000]
+"""
+
+import argparse
+import importlib
+import json
+import time
+
+import linkedin2username
+from benchmarks.corpus import make_names, make_page
+
+
+def legacy_parse(result):
+    """The upsell check and find_employees as they were."""
+    if "UPSELL_LIMIT" in result:
+        return False
+    result_json = json.loads(result)
+    search_clusters = result_json.get('data', {}).get('searchDashClustersByAll', {})
+    if search_clusters.get('paging', {}).get('total', 0) == 0:
+        return False
+
+    found_employees = []
+    for element in search_clusters.get('elements', []):
+        for item_body in element.get('items', []):
+            entity = item_body.get('item', {}).get('entityResult', {})
+            if not entity:
+                continue
+            occupation = entity.get('primarySubtitle', {}).get('text', '') if entity.get('primarySubtitle') else ''
+            found_employees.append({'full_name': entity['title']['text'].strip(), 'occupation': occupation})
+    return found_employees
+
+
+def run(label, parse, page, count):
+    """Parses the page count times and prints the time per page."""
+    start = time.perf_counter()
+    for _ in range(count):
+        parse(page)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<16} {elapsed / count * 1e6:>10,.0f} us/page")
+    return elapsed
+
+
+def main():
+    """Main Function"""
+    parser = argparse.ArgumentParser(description='Search page parsing benchmark')
+    parser.add_argument('--count', type=int, default=2000,
+                        help='Times each page is parsed. Defaults to 2000.')
+    args = parser.parse_args()
+
+    with open('tests/mock-employee-response', encoding='utf-8') as infile:
+        mock = infile.read()
+    people = [(name, 'Software Engineer', f'urn:li:member:{index}') for index, name in enumerate(make_names(50))]
+    pages = {'mock': mock, 'synthetic': make_page(people, 1000)}
+
+    for name, page in pages.items():
+        print(f"\n{name} page, {len(page.encode()) / 1024:.0f} KiB")
+        before = run('legacy', legacy_parse, page, args.count)
+        for backend in ('json', 'orjson'):
+            try:
+                linkedin2username.json_loads = importlib.import_module(backend).loads
+            except ImportError:
+                continue
+            after = run(f'parse ({backend})', linkedin2username.parse_results, page, args.count)
+            print(f"{'speedup':<16} {before / after:>10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
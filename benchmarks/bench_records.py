@@ -0,0 +1,53 @@
+"""
+Measures the memory held by employees found in a big run: the dicts
+find_employees used to return against Employee records with interned
+occupations.
+
+Usage: python -m benchmarks.bench_records [--count 100000]
+"""
+
+import argparse
+import json
+import random
+import sys
+import tracemalloc
+
+from linkedin2username import Employee
+from benchmarks.corpus import make_names
+
+OCCUPATIONS = ['Software Engineer', 'Sales Associate', 'Account Executive',
+               'Project Manager', 'Customer Success Manager', 'Recruiter']
+
+
+def measure(label, build, payload):
+    """Prints the memory still allocated after building the employees."""
+    tracemalloc.start()
+    employees = build(json.loads(payload))
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<10} {current / 1024 / 1024:>8.1f} MiB  ({current / len(employees):.0f} bytes/employee)")
+    return current
+
+
+def main():
+    """Main Function"""
+    parser = argparse.ArgumentParser(description='Employee record memory benchmark')
+    parser.add_argument('--count', type=int, default=100000,
+                        help='Number of employees. Defaults to 100000.')
+    args = parser.parse_args()
+
+    # Every occupation comes out of the JSON decoder as a fresh string, like it
+    # does when parsing search results.
+    rng = random.Random(1)
+    payload = json.dumps([[name, rng.choice(OCCUPATIONS), f'urn:li:member:{index}']
+                          for index, name in enumerate(make_names(args.count))])
+
+    before = measure('dicts', lambda rows: [{'full_name': name, 'occupation': occupation, 'urn': urn}
+                                            for name, occupation, urn in rows], payload)
+    after = measure('records', lambda rows: [Employee(name, sys.intern(occupation), urn)
+                                             for name, occupation, urn in rows], payload)
+    print(f"saved      {(before - after) / before:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
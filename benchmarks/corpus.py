@@ -0,0 +1,67 @@
+"""
+Synthetic name corpus for the benchmarks.
+
+Names are built from a small pool of parts and decorations that look like what
+shows up in real LinkedIn searches: accents, titles, credentials in
+parenthesis, emojis and double-barrelled surnames.
+"""
+
+import copy
+import json
+import os
+import random
+
+FIRST_NAMES = ['John', 'José', 'Zoë', 'Hannibal', 'Jean-Paul', 'Ana', 'Sören',
+               'Michael', 'Freddy', 'Björn', 'Chloé', 'Iñigo', 'Madonna', 'Twiggy']
+MIDDLE_NAMES = ['', '', '', 'Wayne', 'Maria', 'de la', 'van', 'Lee']
+LAST_NAMES = ['Smith', 'Gonzáles', 'Davidson-Smith', 'Müller', 'Lecter', 'Pérez',
+              'Krueger', 'Myers', 'Ramirez', 'Gacey', 'Ångström', 'Straße']
+PREFIXES = ['', '', '', '', 'Dr. ', 'Mr. ', 'Prof. ', '🙂 ']
+SUFFIXES = ['', '', '', '', ', PhD', ' MD, MBA', ' (OSCP, OSCE)', ' 🙂', ' CISSP']
+
+
+def make_names(count, seed=1):
+    """Returns a list of count raw full names, reproducible for a given seed."""
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        middle = rng.choice(MIDDLE_NAMES)
+        names.append(rng.choice(PREFIXES)
+                     + rng.choice(FIRST_NAMES) + ' '
+                     + (middle + ' ' if middle else '')
+                     + rng.choice(LAST_NAMES)
+                     + rng.choice(SUFFIXES))
+    return names
+
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       'tests', 'mock-employee-response')
+
+
+def make_page(employees, total, start=0):
+    """
+    Returns a page of search results as LinkedIn sends it, as text.
+
+    employees are (full_name, occupation, urn) tuples. Every person gets a copy of
+    the first profile in tests/mock-employee-response, with all the image and
+    tracking fields a real page carries, so pages have a realistic size.
+    """
+    with open(FIXTURE, encoding='utf-8') as infile:
+        page = json.load(infile)
+
+    clusters = page['data']['searchDashClustersByAll']
+    template = clusters['elements'][0]['items'][0]
+    items = []
+    for position, (full_name, occupation, urn) in enumerate(employees, start + 1):
+        item = copy.deepcopy(template)
+        entity = item['item']['entityResult']
+        entity['title']['text'] = full_name
+        entity['primarySubtitle']['text'] = occupation
+        entity['trackingUrn'] = entity['entityUrn'] = urn
+        item['position'] = position
+        items.append(item)
+
+    clusters['elements'][0]['items'] = items
+    clusters['paging'].update(start=start, count=50, total=total)
+    clusters['metadata']['totalResultCount'] = total
+    return json.dumps(page, ensure_ascii=False)
@@ -0,0 +1,242 @@
+"""
+A local stand-in for the LinkedIn endpoints linkedin2username uses, so runs can
+be load tested end to end without an account.
+
+It serves /voyager/api/organization/companies and /voyager/api/graphql in the
+shape get_company_info and parse_results read, and /voyager/api/me for
+session_valid. Every company asked for exists, with made up employees:
+unicode-heavy names, namesakes, people listed in more than one region, and
+occupations to search by keyword. Searches stop giving results past LinkedIn's
+1000, and the stand-in can add latency, throttle with 429s, and start showing the
+commercial search limit or turning the session away after a number of searches.
+
+Usage: python -m benchmarks.standin [--port 8080] [--employees 5000]
+           [--latency 0.2] [--throttle 0.05] [--upsell-after 200]
+
+Then point the CLI or the server at it:
+    LI2U_LINKEDIN_URL=http://127.0.0.1:8080 python linkedin2username.py -c anyco -g
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from linkedin2username import GEO_REGIONS, SEARCH_LIMIT
+from benchmarks.corpus import make_names, make_page
+
+# Names LinkedIn members really use that the corpus doesn't cover: other
+# scripts, letters with no ASCII fold, and emoji.
+UNICODE_NAMES = ['Søren Kierkegaard', 'Łukasz Żółć', 'Анна Каренина', '李 小龍',
+                 'Nguyễn Thị Minh Khai', 'José María Aznar-López', "Seán O'Brien",
+                 'Þórunn Ægisdóttir', '🚀 Ada Lovelace 🚀', 'Αλέξανδρος Παπαδόπουλος']
+OCCUPATIONS = ['Software Engineer', 'Sales Associate', 'Account Executive', 'Human Resources Partner',
+               'Information Technology Manager', 'Recruiter', 'Customer Success Manager', 'Intern']
+
+# Most people are in a handful of regions, like real companies.
+BIG_REGIONS = ['us', 'gb', 'de', 'fr', 'au']
+
+
+class Company():
+    """
+    Made up employees of one company, the same every time for a given name.
+
+    Each person has a home region and one in ten is listed in a second one too, so
+    geoblast runs see them twice. One in fifty shares the name of the person before
+    them, with their own profile.
+    """
+    def __init__(self, name, employees, seed=1):
+        self.name = name
+        self.id = str(zlib.crc32(name.encode()))
+        rng = random.Random(f'{seed}:{name}')
+
+        names = make_names(employees, seed)
+        regions = list(GEO_REGIONS.values())
+        big = [GEO_REGIONS[region] for region in BIG_REGIONS]
+        self.people = []
+        for index, full_name in enumerate(names):
+            if index % 10 == 3:
+                full_name = rng.choice(UNICODE_NAMES)
+            elif index % 50 == 49:
+                full_name = self.people[-1][0]
+
+            home = rng.choice(big) if rng.random() < 0.8 else rng.choice(regions)
+            listed = {home, rng.choice(regions)} if rng.random() < 0.1 else {home}
+            self.people.append((full_name, rng.choice(OCCUPATIONS), f'urn:li:member:{self.id}{index}', listed))
+
+    def info(self):
+        """The company lookup reply."""
+        return json.dumps({'elements': [{
+            'name': self.name.title(),
+            'tagline': 'A company that does not exist',
+            'staffCount': len(self.people),
+            'companyPageUrl': f'https://{self.name}.example',
+            'trackingInfo': {'objectUrn': f'urn:li:company:{self.id}'},
+        }]})
+
+    def search(self, start, region, keyword):
+        """A page of search results, 50 people from start."""
+        keyword = keyword.lower()
+        found = [person[:3] for person in self.people
+                 if (not region or region in person[3]) and keyword in person[1].lower()]
+
+        # Like LinkedIn, the total is everybody but only the first 1000 come back
+        page = found[start:min(start + 50, SEARCH_LIMIT)] if start < SEARCH_LIMIT else []
+        return make_page(page, len(found), start)
+
+
+class StandIn():
+    """
+    The state of a stand-in: its companies, how it misbehaves, and counters of
+    what it was asked.
+
+    latency is the seconds every reply takes, throttle the chance of a search
+    getting a 429 with a Retry-After of retry_after seconds, and upsell_after the
+    number of searches after which every search shows the commercial limit.
+    After expire_after searches every request gets a 401, like once a session
+    expired.
+    """
+    def __init__(self, employees=5000, latency=0, throttle=0, retry_after=1, upsell_after=None, seed=1,
+                 expire_after=None):
+        self.employees = employees
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.upsell_after = upsell_after
+        self.expire_after = expire_after
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.companies = {}
+        self.lock = threading.Lock()
+        self.searches = 0
+        self.throttled = 0
+        self.upsold = 0
+
+    def company(self, name):
+        """Returns a company by universalName, made up the first time."""
+        with self.lock:
+            for company in self.companies.values():
+                if company.name == name:
+                    return company
+            company = Company(name, self.employees, self.seed)
+            self.companies[company.id] = company
+            return company
+
+    def reply(self, path, query):
+        """Returns the status code, extra headers and body for a request."""
+        time.sleep(self.latency)
+
+        if self.expire_after is not None and self.searches >= self.expire_after:
+            return 401, {}, '{}'
+
+        if path == '/voyager/api/organization/companies':
+            name = urllib.parse.parse_qs(query).get('universalName', [''])[0]
+            if not name:
+                return 404, {}, '{}'
+            return 200, {}, self.company(name).info()
+
+        if path == '/voyager/api/me':
+            return 200, {}, json.dumps({'plainId': 1, 'miniProfile': {'firstName': 'Stand', 'lastName': 'In'}})
+
+        if path != '/voyager/api/graphql':
+            return 404, {}, '{}'
+
+        with self.lock:
+            self.searches += 1
+            if self.upsell_after is not None and self.searches > self.upsell_after:
+                self.upsold += 1
+                return 200, {}, json.dumps({'data': {'searchDashClustersByAll': {'metadata': {
+                    'primaryFilterCluster': {'type': 'UPSELL_LIMIT'}}}}})
+            if self.rng.random() < self.throttle:
+                self.throttled += 1
+                return 429, {'Retry-After': str(self.retry_after)}, ''
+
+        variables = urllib.parse.unquote(query)
+        company_id = re.search(r'key:currentCompany,value:List\((\d+)\)', variables)
+        company = self.companies.get(company_id.group(1)) if company_id else None
+        if company is None:
+            return 200, {}, make_page([], 0)
+
+        start = re.search(r'start:(\d+)', variables)
+        region = re.search(r'key:geoUrn,value:List\((\d+)\)', variables)
+        keyword = re.search(r'keywords:([^,)]*)', variables)
+        return 200, {}, company.search(int(start.group(1)) if start else 0,
+                                       region.group(1) if region else '',
+                                       keyword.group(1) if keyword else '')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers requests from the StandIn of its server."""
+    def do_GET(self):
+        # LinkedIn refuses requests without the CSRF token
+        if not self.headers.get('Csrf-Token'):
+            status, headers, body = 403, {}, 'CSRF check failed.'
+        else:
+            path, _, query = self.path.partition('?')
+            status, headers, body = self.server.standin.reply(path, query)
+
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(standin, host='127.0.0.1', port=0):
+    """
+    Starts serving a StandIn on a background thread, returning the server. Its url
+    attribute is what LI2U_LINKEDIN_URL should be set to.
+    """
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    server.daemon_threads = True
+    server.standin = standin
+    server.url = f'http://{host}:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    """Main Function"""
+    parser = argparse.ArgumentParser(description='Local LinkedIn stand-in')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Defaults to 127.0.0.1.')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on. Defaults to 8080.')
+    parser.add_argument('--employees', type=int, default=5000,
+                        help='Employees of every company. Defaults to 5000.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds every reply takes. Defaults to 0.')
+    parser.add_argument('--throttle', type=float, default=0,
+                        help='Chance of a search getting a 429, from 0 to 1. Defaults to 0.')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After sent with 429s, in seconds. Defaults to 1.')
+    parser.add_argument('--upsell-after', type=int, default=None,
+                        help='Searches after which the commercial search limit shows. Never by default.')
+    parser.add_argument('--expire-after', type=int, default=None,
+                        help='Searches after which every request gets a 401. Never by default.')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the made up employees.')
+    args = parser.parse_args()
+
+    standin = StandIn(args.employees, args.latency, args.throttle, args.retry_after, args.upsell_after, args.seed,
+                      args.expire_after)
+    server = serve(standin, args.host, args.port)
+    print(f"[*] LinkedIn stand-in listening, use LI2U_LINKEDIN_URL={server.url}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print(f"\n[*] {standin.searches} searches, {standin.throttled} throttled, {standin.upsold} upsold")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Benchmark suite for the hot paths, with a stored baseline to catch regressions.
+
+Every case runs at each scale (number of names) twice: once timed, reporting
+names per second, and once under tracemalloc, reporting the peak memory. The
+results are compared against benchmarks/baseline.json and the suite fails when a
+case got slower, or its peak grew, by more than --threshold percent.
+
+Shared machines vary in speed from one minute to the next, so cases that look
+like they regressed are measured again, up to RECHECKS times, keeping their best
+result before the suite fails. Baselines only mean something on the machine they
+were taken on, so take a new one with --save before comparing on another machine.
+
+Usage: python -m benchmarks.suite [--scales 1000 100000 1000000] [--cases clean_name ...]
+           [--threshold 20] [--save] [--baseline benchmarks/baseline.json]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import linkedin2username
+from linkedin2username import Employee, NameMutator
+from benchmarks.corpus import make_names, make_page
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+SCALES = [1000, 100000, 1000000]
+THRESHOLD = 20
+RECHECKS = 2
+MUTATIONS = ['f_last', 'f_dot_last', 'last_f', 'first_dot_last', 'first_l', 'first']
+
+# Small scales are timed over and over for at least this many seconds, keeping
+# the best run, so they aren't all noise.
+MIN_TIME = 0.5
+
+# Search pages are 170 KiB each, so the parsing case goes over a few of them again
+# and again rather than making a million names worth.
+PAGES = 20
+
+
+def clear_caches():
+    """Starts a case from cold name caches, like a new run."""
+    linkedin2username.parse_name.cache_clear()
+    linkedin2username.DEFAULT_FORMATS.mutate.cache_clear()
+
+
+def clean_name(names, _):
+    """NameMutator.clean_name on every name."""
+    return lambda: [NameMutator.clean_name(name) for name in names]
+
+
+def split_name(names, _):
+    """NameMutator.split_name on every cleaned name."""
+    cleaned = [NameMutator.clean_name(name) for name in names]
+    return lambda: [NameMutator.split_name(name) for name in cleaned]
+
+
+def mutation(method):
+    """One NameMutator method on every name."""
+    def case(names, _):
+        mutators = [NameMutator(name) for name in names]
+        clear_caches()
+        return lambda: [getattr(mutator, method)() for mutator in mutators if mutator.name]
+    case.__doc__ = f"NameMutator.{method} on every name."
+    return case
+
+
+def find_employees(names, _):
+    """find_employees on pages of 50 people until every name was parsed."""
+    people = [(name, 'Software Engineer', f'urn:li:member:{index}') for index, name in enumerate(names[:PAGES * 50])]
+    pages = [make_page(people[start:start + 50], len(names), start) for start in range(0, len(people), 50)]
+    count = -(-len(names) // 50)
+    return lambda: [linkedin2username.find_employees(page) for page in itertools.islice(itertools.cycle(pages), count)]
+
+
+def write_files(names, out_dir):
+    """write_files for every name, all the default formats."""
+    employees = [Employee(name, 'Software Engineer', f'urn:li:member:{index}') for index, name in enumerate(names)]
+    return lambda: linkedin2username.write_files('bench', '@example.com', employees, out_dir)
+
+
+def offline(names, out_dir):
+    """remutate_files over a rawnames file, the whole --offline pipeline."""
+    with open(os.path.join(out_dir, 'bench-rawnames.txt'), 'w', encoding='utf-8') as outfile:
+        outfile.write(''.join(name + '\n' for name in names))
+    return lambda: linkedin2username.remutate_files('bench', '@example.com', out_dir)
+
+
+CASES = {'clean_name': clean_name, 'split_name': split_name}
+CASES.update({method: mutation(method) for method in MUTATIONS})
+CASES.update({'find_employees': find_employees, 'write_files': write_files, 'offline': offline})
+
+
+def measure(case, names):
+    """
+    Runs a case timed, best of as many runs as fit in MIN_TIME, then once under
+    tracemalloc. Returns names/sec and peak bytes.
+    """
+    with tempfile.TemporaryDirectory() as out_dir:
+        run = case(names, out_dir)
+        elapsed = []
+        while not elapsed or sum(elapsed) < MIN_TIME:
+            clear_caches()
+            start = time.perf_counter()
+            run()
+            elapsed.append(time.perf_counter() - start)
+
+        run = case(names, out_dir)
+        clear_caches()
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {'rate': len(names) / min(elapsed), 'peak': peak}
+
+
+def run(name, names):
+    """Measures a case by name and prints the result."""
+    result = measure(CASES[name], names)
+    print(f"{name:<16} {len(names):>9,} {result['rate']:>14,.0f} names/sec {result['peak'] / 1024 / 1024:>10.1f} MiB peak")
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns (case, scale, reason) for every result that regressed beyond threshold
+    percent against the baseline, slower or with a higher peak.
+    """
+    regressions = []
+    for name, scales in results.items():
+        for scale, result in scales.items():
+            before = baseline.get(name, {}).get(scale)
+            if not before:
+                continue
+            slower = (before['rate'] - result['rate']) / before['rate'] * 100
+            bigger = (result['peak'] - before['peak']) / before['peak'] * 100 if before['peak'] else 0
+            if slower > threshold:
+                regressions.append((name, scale, f"{slower:.0f}% slower"))
+            if bigger > threshold:
+                regressions.append((name, scale, f"{bigger:.0f}% more memory"))
+    return regressions
+
+
+def main():
+    """Main Function"""
+    parser = argparse.ArgumentParser(description='Benchmark suite with regression thresholds')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES,
+                        help='Numbers of names to run every case with. Defaults to 1k, 100k and 1M.')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES),
+                        help='Cases to run. Defaults to all of them.')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help=f'Percent a case may regress before the suite fails. Defaults to {THRESHOLD}.')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='Baseline file. Defaults to benchmarks/baseline.json.')
+    parser.add_argument('--save', action='store_true',
+                        help='Replace the baseline file with the results instead of comparing.')
+    args = parser.parse_args()
+
+    results = {}
+    for scale in args.scales:
+        names = make_names(scale)
+        for name in args.cases:
+            results.setdefault(name, {})[str(scale)] = run(name, names)
+
+    if args.save:
+        baseline = results
+        with open(args.baseline, 'w', encoding='utf-8') as outfile:
+            json.dump(baseline, outfile, indent=2, sort_keys=True)
+            outfile.write('\n')
+        print(f"\n[*] Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\n[!] No baseline at {args.baseline}, take one with --save.")
+        return 1
+
+    with open(args.baseline, encoding='utf-8') as infile:
+        baseline = json.load(infile)
+    regressions = compare(results, baseline, args.threshold)
+
+    # Give whatever looks regressed another chance, it may have been the machine
+    for _ in range(RECHECKS):
+        if not regressions:
+            break
+        print(f"\n[*] Measuring {len(regressions)} possible regressions again")
+        for name, scale in sorted({(name, scale) for name, scale, _ in regressions}):
+            again = run(name, make_names(int(scale)))
+            best = results[name][scale]
+            results[name][scale] = {'rate': max(best['rate'], again['rate']), 'peak': min(best['peak'], again['peak'])}
+        regressions = compare(results, baseline, args.threshold)
+
+    for name, scale, reason in regressions:
+        print(f"[!] Regression: {name} at {scale} names: {reason}")
+    if regressions:
+        return 1
+    print(f"\n[*] No regressions beyond {args.threshold:.0f}%")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,12 +13,29 @@ import sys
 import re
 import time
 import argparse
+import collections
+import contextlib
+import cProfile
+import functools
+import importlib.util
 import json
+import mmap
+import shutil
+import sqlite3
+import string
+import tempfile
+import threading
 import urllib.parse
-import requests
-import urllib3
+import zlib
+from typing import NamedTuple
 
-from dphelper import DPHelper
+# Search pages are decoded with orjson when it is installed, it is about twice as
+# fast as the standard library on them.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 BANNER = r"""
 
@@ -87,6 +104,92 @@ GEO_REGIONS = {
 }
 
 
+# Use case for tool is mostly standard English, so common non-English characters
+# are folded down to their closest ASCII letters. Applied with str.translate after
+# lower-casing the name.
+NAME_FOLD_TABLE = str.maketrans({
+    **dict.fromkeys('àáâãäå', 'a'),
+    **dict.fromkeys('èéêë', 'e'),
+    **dict.fromkeys('ìíîï', 'i'),
+    **dict.fromkeys('òóôõö', 'o'),
+    **dict.fromkeys('ùúûü', 'u'),
+    **dict.fromkeys('ýÿ', 'y'),
+    'ß': 'ss',
+    'ñ': 'n',
+})
+
+# Lots of people put various credentials, etc in parenthesis. Those are dropped
+# together with anything weird left over (emojis, commas, dots, quotes...).
+# People like to feel special, I guess.
+NAME_STRIP_RE = re.compile(r'\([^()]*\)|[^a-zA-Z ()-]+|[()]')
+
+# Common titles, only removed once the name has been stripped down to letters.
+NAME_TITLES = ['mr', 'miss', 'mrs', 'phd', 'prof', 'professor', 'md', 'dr', 'mba']
+NAME_TITLES_RE = re.compile(r'\b(' + '|'.join(NAME_TITLES) + r')\b')
+
+# Name parts are separated by spaces and dashes (including repeated ones)
+NAME_TOKEN_RE = re.compile(r'[^\s-]+')
+
+# Upper bound on the number of entries kept in each of the name caches (raw names and
+# split names). Geoblast and keyword runs return the same people over and over, and
+# lots of employees share first names and surnames.
+NAME_CACHE_SIZE = 65536
+
+# LinkedIn replies are cached on disk for a while, so that re-running the same
+# company to change output options doesn't fetch everything again.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'linkedin2username')
+CACHE_TTL = 12 * 3600
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# The cookies of the last login are kept here, readable by the user only, and
+# reused for as long as LinkedIn still takes them.
+SESSION_FILE = os.path.join(CACHE_DIR, 'session.json')
+
+# Throttled (429) and failed (5xx) searches are retried a few times, waiting
+# BACKOFF_BASE seconds and doubling each time unless LinkedIn says how long with
+# Retry-After. No wait is ever longer than BACKOFF_MAX.
+RETRIES = 3
+BACKOFF_BASE = 2
+BACKOFF_MAX = 300
+PACER_BURST = 5
+
+# A search that doesn't answer within this many seconds is retried like a failed
+# one. This also bounds how long a prefetching thread can hold up exit after Ctrl-C.
+SEARCH_TIMEOUT = 30
+
+# LinkedIn stops giving results past this many for any one search.
+SEARCH_LIMIT = 1000
+
+# Where LinkedIn is. LI2U_LINKEDIN_URL points the CLI and the server at a
+# stand-in instead, like benchmarks/standin.py, in which case there's no browser
+# login: the stand-in takes any session.
+LINKEDIN_DEFAULT_URL = 'https://www.linkedin.com'
+LINKEDIN_URL = os.environ.get('LI2U_LINKEDIN_URL', LINKEDIN_DEFAULT_URL).rstrip('/')
+STANDIN_COOKIES = {'JSESSIONID': '"ajax:standin"'}
+
+# Username formats written for each company, in the order they are written. Each one
+# ends up in {company}-{name}.txt, where the name is the template without its braces.
+# See compile_format for the fields a template can use.
+USERNAME_FORMATS = [
+    '{f}{last}',
+    '{f}.{last}',
+    '{first}{l}',
+    '{first}.{last}',
+    '{first}',
+    '{last}{f}',
+]
+
+# Fields available to username format templates, in the order compiled templates
+# receive them.
+FORMAT_FIELDS = ('first', 'f', 'second', 's', 'last', 'l')
+
+# Format names are used in file names, so keep them boring.
+FORMAT_NAME_RE = re.compile(r'^[\w.@+-]+$')
+
+# Output files that aren't username formats, which no format may be named after.
+RESERVED_FORMAT_NAMES = ('rawnames', 'metadata')
+
+
 class NameMutator():
     """
     This class handles all name mutations.
@@ -94,8 +197,7 @@ class NameMutator():
     Init with a raw name, and then call the individual functions to return a mutation.
     """
     def __init__(self, name):
-        self.name = self.clean_name(name)
-        self.name = self.split_name(self.name)
+        self.name = parse_name(name)
 
     @staticmethod
     def clean_name(name):
@@ -105,40 +207,25 @@ class NameMutator():
         LinkedIn users tend to add credentials to their names to look special.
         This function is based on what I have seen in large searches, and attempts
         to remove them.
+
+        All the patterns and tables used here are built once at import time, see
+        the NAME_* constants above the class.
         """
         # Lower-case everything to make it easier to de-duplicate.
         name = name.lower()
 
-        # Use case for tool is mostly standard English, try to standardize common non-English
-        # characters.
-        name = re.sub("[àáâãäå]", 'a', name)
-        name = re.sub("[èéêë]", 'e', name)
-        name = re.sub("[ìíîï]", 'i', name)
-        name = re.sub("[òóôõö]", 'o', name)
-        name = re.sub("[ùúûü]", 'u', name)
-        name = re.sub("[ýÿ]", 'y', name)
-        name = re.sub("[ß]", 'ss', name)
-        name = re.sub("[ñ]", 'n', name)
-
-        # Get rid of all things in parenthesis. Lots of people put various credentials, etc
-        name = re.sub(r'\([^()]*\)', '', name)
-
-        # The lines below basically trash anything weird left over.
-        # A lot of users have funny things in their names, like () or ''
-        # People like to feel special, I guess.
-        allowed_chars = re.compile('[^a-zA-Z -]')
-        name = allowed_chars.sub('', name)
-
-        # Next, we get rid of common titles. Thanks ChatGPT for the help.
-        titles = ['mr', 'miss', 'mrs', 'phd', 'prof', 'professor', 'md', 'dr', 'mba']
-        pattern = "\\b(" + "|".join(titles) + ")\\b"
-        name = re.sub(pattern, '', name)
-
-        # The line below tries to consolidate white space between words
-        # and get rid of leading/trailing spaces.
-        name = re.sub(r'\s+', ' ', name).strip()
-
-        return name
+        # Standardize common non-English characters. Plain ASCII names have none.
+        if not name.isascii():
+            name = name.translate(NAME_FOLD_TABLE)
+
+        # Get rid of all things in parenthesis and anything weird left over.
+        name = NAME_STRIP_RE.sub('', name)
+
+        # Next, we get rid of common titles.
+        name = NAME_TITLES_RE.sub('', name)
+
+        # Consolidate white space between words and get rid of leading/trailing spaces.
+        return ' '.join(name.split())
 
     @staticmethod
     def split_name(name):
@@ -148,83 +235,168 @@ class NameMutator():
         Some people have funny names. We assume the most important names are:
         first name, last name, and the name right before the last name (if they have one)
         """
-        # Split on spaces and dashes (included repeated)
-        parsed = re.split(r'[\s-]+', name)
-
-        # Iterate and remove empty strings
-        parsed = [part for part in parsed if part]
+        # Split on spaces and dashes (included repeated), empty parts are never matched
+        parsed = NAME_TOKEN_RE.findall(name)
 
         # Discard people without at least a first and last name
         if len(parsed) < 2:
             return None
 
         if len(parsed) > 2:
-            split_name = {'first': parsed[0], 'second': parsed[-2], 'last': parsed[-1]}
-        else:
-            split_name = {'first': parsed[0], 'second': '', 'last': parsed[-1]}
+            return {'first': parsed[0], 'second': parsed[-2], 'last': parsed[-1]}
 
-        # Final sanity check to not proceed without first and last name
-        if not split_name['first'] or not split_name['last']:
-            return None
+        return {'first': parsed[0], 'second': '', 'last': parsed[-1]}
 
-        return split_name
+    def mutate(self, template):
+        """Returns the usernames (set) of one of the USERNAME_FORMATS templates."""
+        name = self.name
+        usernames = DEFAULT_FORMATS.mutate(name['first'], name['second'], name['last'])
+        return set(usernames[DEFAULT_FORMATS.templates.index(template)])
 
     def f_last(self):
         """jsmith"""
-        names = set()
-        names.add(self.name['first'][0] + self.name['last'])
-
-        if self.name['second']:
-            names.add(self.name['first'][0] + self.name['second'])
-
-        return names
+        return self.mutate('{f}{last}')
 
     def f_dot_last(self):
         """j.smith"""
-        names = set()
-        names.add(self.name['first'][0] + '.' + self.name['last'])
-
-        if self.name['second']:
-            names.add(self.name['first'][0] + '.' + self.name['second'])
-
-        return names
+        return self.mutate('{f}.{last}')
 
     def last_f(self):
         """smithj"""
-        names = set()
-        names.add(self.name['last'] + self.name['first'][0])
-
-        if self.name['second']:
-            names.add(self.name['second'] + self.name['first'][0])
-
-        return names
+        return self.mutate('{last}{f}')
 
     def first_dot_last(self):
         """john.smith"""
-        names = set()
-        names.add(self.name['first'] + '.' + self.name['last'])
-
-        if self.name['second']:
-            names.add(self.name['first'] + '.' + self.name['second'])
-
-        return names
+        return self.mutate('{first}.{last}')
 
     def first_l(self):
         """johns"""
-        names = set()
-        names.add(self.name['first'] + self.name['last'][0])
-
-        if self.name['second']:
-            names.add(self.name['first'] + self.name['second'][0])
-
-        return names
+        return self.mutate('{first}{l}')
 
     def first(self):
         """john"""
-        names = set()
-        names.add(self.name['first'])
+        return self.mutate('{first}')
+
+
+@functools.lru_cache(maxsize=NAME_CACHE_SIZE)
+def parse_name(full_name):
+    """
+    Cleans and splits a raw full name, memoized on the raw name.
+
+    Returns the same thing as NameMutator.split_name. The dict is shared between
+    everyone asking for the same name, so treat it as read-only.
+    """
+    return NameMutator.split_name(NameMutator.clean_name(full_name))
+
+
+def parse_format(template):
+    """
+    Splits a username format template into (literal, field) pairs.
+
+    The field is None when the template ends with a literal. Raises ValueError for
+    unknown fields or anything str.format would choke on.
+    """
+    pieces = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if field is not None and (field not in FORMAT_FIELDS or spec or conversion):
+            raise ValueError(f"unknown field {{{field}}} in username format {template}")
+        pieces.append((literal, field))
+    return pieces
+
 
-        return names
+def expands_second(template):
+    """Tells if a template is also rendered with the second name in place of the last name."""
+    fields = {field for _, field in parse_format(template)}
+    return bool(fields & {'last', 'l'}) and not fields & {'second', 's'}
+
+
+def compile_format(template):
+    """
+    Compiles a username format template into a function of (first, second, last).
+
+    Templates use the fields below, anything else is copied as-is:
+        {first} {f}    first name and its initial
+        {last} {l}     last name and its initial
+        {second} {s}   name right before the last name and its initial, empty if none
+
+    Like the original hand-written formats, a template using {last} or {l} is also
+    rendered with the second name in place of the last name when there is one. The
+    function returns a tuple with one or two usernames.
+
+    Raises ValueError for unknown fields or anything str.format would choke on.
+    """
+    pattern = ''
+    for literal, field in parse_format(template):
+        pattern += literal.replace('{', '{{').replace('}', '}}')
+        if field:
+            pattern += '{' + str(FORMAT_FIELDS.index(field)) + '}'
+
+    render = pattern.format
+    if not expands_second(template):
+        def mutate(first, second, last):
+            return (render(first, first[0], second, second[:1], last, last[0]),)
+        return mutate
+
+    def mutate_expanded(first, second, last):
+        username = render(first, first[0], second, second[:1], last, last[0])
+        if second:
+            other = render(first, first[0], second, second[0], second, second[0])
+            if other != username:
+                return (username, other)
+        return (username,)
+    return mutate_expanded
+
+
+def format_name(template):
+    """Returns the name of a username format, used in its file name."""
+    name = template.replace('{', '').replace('}', '')
+    if not FORMAT_NAME_RE.match(name):
+        raise ValueError(f"username format {template} can't be used in a file name")
+    return name
+
+
+class UsernameFormats():
+    """
+    A list of username format templates, compiled once.
+
+    mutate() renders every format from one split name in a single call, and is
+    memoized on the (first, second, last) parts since lots of people share names.
+    """
+    def __init__(self, templates):
+        # Keep the first occurrence of each template, in order
+        self.templates = list(dict.fromkeys(templates))
+        self.names = [format_name(template) for template in self.templates]
+
+        # Every format gets its own file, and must not overwrite any other
+        for template, name in zip(self.templates, self.names):
+            if not any(field for _, field in parse_format(template)):
+                raise ValueError(f"username format {template} has no field")
+            if name in RESERVED_FORMAT_NAMES:
+                raise ValueError(f"username format {template} would overwrite the {name} file")
+            if self.names.count(name) > 1:
+                others = [other for other, same in zip(self.templates, self.names) if same == name and other != template]
+                raise ValueError(f"username formats {template} and {others[0]} would both write {name}.txt")
+        self.compiled = [compile_format(template) for template in self.templates]
+        self.mutate = functools.lru_cache(maxsize=NAME_CACHE_SIZE)(self._mutate)
+
+    def _mutate(self, first, second, last):
+        """Returns one tuple of usernames per template, in template order."""
+        return tuple([mutate(first, second, last) for mutate in self.compiled])
+
+    @classmethod
+    def with_extra(cls, templates):
+        """Returns the default USERNAME_FORMATS followed by some extra templates."""
+        if not templates:
+            return DEFAULT_FORMATS
+        return cls(USERNAME_FORMATS + list(templates))
+
+
+DEFAULT_FORMATS = UsernameFormats(USERNAME_FORMATS)
+
+
+def name_cache_stats(formats=DEFAULT_FORMATS):
+    """Returns the hit/miss counters of the name caches."""
+    return {'names': parse_name.cache_info(), 'usernames': formats.mutate.cache_info()}
 
 
 def parse_arguments():
@@ -251,8 +423,18 @@ def parse_arguments():
                         help='Search depth (how many loops of 50). If unset, '
                         'will try to grab them all.')
     parser.add_argument('-s', '--sleep', type=int, action='store', default=0,
-                        help='Seconds to sleep between search loops.'
+                        help='Seconds to wait at least between search requests.'
                         ' Defaults to 0.')
+    parser.add_argument('--rate', type=float, action='store', default=None,
+                        help='Average search requests per second, in bursts of up'
+                        f' to {PACER_BURST}. Unlimited by default, apart from --sleep.')
+    parser.add_argument('--retries', type=int, action='store', default=RETRIES,
+                        help='Times to retry a throttled or failed search page,'
+                        f' backing off in between. Defaults to {RETRIES}.')
+    parser.add_argument('--prefetch', type=int, action='store', default=1,
+                        help='Search pages to request ahead while the current one'
+                        ' is parsed and written. Set to 0 to fetch one page at a'
+                        ' time. Defaults to 1.')
     parser.add_argument('-x', '--proxy', type=str, action='store',
                         default=False,
                         help='Proxy server to use. WARNING: WILL DISABLE SSL '
@@ -270,6 +452,40 @@ def parse_arguments():
                         ' regions.')
     parser.add_argument('-o', '--output', default="li2u-output", action="store",
                         help='Output Directory, defaults to li2u-output')
+    parser.add_argument('--profile', dest='profile_path', type=str, action='store', default=None,
+                        help='Write a JSON report of where the time went to this file:'
+                        ' phases, every search request, parse and write times.')
+    parser.add_argument('--cprofile', type=str, action='store', default=None,
+                        help='With --profile, also dump cProfile stats of the parsing,'
+                        ' mutating and writing to this file.')
+    parser.add_argument('-r', '--resume', default=False, action='store_true',
+                        help='Resume a run that did not finish, using the journal it'
+                        ' left in the output directory. Pages it already scraped are'
+                        ' not fetched again.')
+    parser.add_argument('--session-file', type=str, action='store', default=SESSION_FILE,
+                        help='Where the LinkedIn session is kept between runs, so the'
+                        f' browser is only needed when it expires. Defaults to {SESSION_FILE}')
+    parser.add_argument('--fresh-login', default=False, action='store_true',
+                        help='Log in with the browser even if the saved session is still good.')
+    parser.add_argument('--cache-ttl', type=int, action='store', default=CACHE_TTL,
+                        help='Seconds a cached LinkedIn reply can be reused by a later'
+                        f' run. Set to 0 to disable the cache. Defaults to {CACHE_TTL}.')
+    parser.add_argument('--cache-dir', type=str, action='store', default=CACHE_DIR,
+                        help=f'Where cached LinkedIn replies are kept. Defaults to {CACHE_DIR}')
+    parser.add_argument('--columnar', default=False, action='store_true',
+                        help='Build usernames as NumPy string columns, meant for very'
+                        ' large result sets, with or without --offline. Requires numpy.')
+    parser.add_argument('--offline', default=False, action='store_true',
+                        help='Do not log in or scrape. Regenerate the username files'
+                        ' from the rawnames file of a previous run in the output'
+                        ' directory, for example with another domain or format.')
+    parser.add_argument('-p', '--processes', type=int, action='store', default=None,
+                        help='Processes used by --offline. Defaults to one per CPU.')
+    parser.add_argument('-f', '--format', dest='formats', action='append', default=[],
+                        help='Extra username format to write, may be repeated. Fields'
+                        ' are {first}, {f}, {second}, {s}, {last} and {l}.'
+                        ' [example: "-f \'{first}_{last}\'" would output'
+                        ' joe_schmoe to first_last.txt]')
 
     args = parser.parse_args()
 
@@ -284,6 +500,40 @@ def parse_arguments():
     if args.keywords:
         args.keywords = args.keywords.split(',')
 
+    # Profiling is off unless asked for:
+    if args.cprofile and not args.profile_path:
+        print("[!] --cprofile needs --profile.")
+        sys.exit()
+    args.profile = RunProfile(args.cprofile) if args.profile_path else None
+
+    # Replies are only cached when scraping, and only if the user wants them to be:
+    args.cache = None
+    if args.cache_ttl > 0 and not args.offline:
+        args.cache = ResponseCache(args.cache_dir, args.cache_ttl)
+
+    # Username formats are compiled once, together with the default ones:
+    try:
+        args.formats = UsernameFormats.with_extra(args.formats)
+    except ValueError as error:
+        print(f"[!] Bad username format: {error}")
+        sys.exit()
+
+    if args.offline and not os.path.exists(f'{args.output}/{args.company}-rawnames.txt'):
+        print(f"[!] --offline needs {args.output}/{args.company}-rawnames.txt from a previous run.")
+        sys.exit()
+
+    if args.prefetch < 0 or args.retries < 0:
+        print("[!] --prefetch and --retries can't be negative.")
+        sys.exit()
+
+    if args.rate is not None and args.rate <= 0:
+        print("[!] --rate must be above 0.")
+        sys.exit()
+
+    if args.columnar and not importlib.util.find_spec('numpy'):
+        print("[!] --columnar needs numpy, install it with 'pip3 install numpy'.")
+        sys.exit()
+
     # These two functions are not currently compatible, squashing this now:
     if args.keywords and args.geoblast:
         print("Sorry, keywords and geoblast are currently not compatible. Use one or the other.")
@@ -295,18 +545,34 @@ def parse_arguments():
 def get_webdriver():
     """
     Try to get a working Selenium browser driver
+
+    The browser stack is only imported here, so offline work never pays for it.
     """
-    browser=DPHelper(browser_path=None,HEADLESS=False)
+    from dphelper import DPHelper
+    browser = DPHelper(browser_path=None, HEADLESS=False)
 
     return browser
 
 
-def login():
+def login(store=None, proxies=None):
     """Creates a new authenticated session.
 
-    This now uses Selenium because I got very tired playing cat/mouse
-    with LinkedIn's login process.
+    The session saved in store by an earlier run is used if LinkedIn still
+    takes it. Otherwise this uses Selenium because I got very tired playing
+    cat/mouse with LinkedIn's login process, and saves the new session.
     """
+    if LINKEDIN_URL != LINKEDIN_DEFAULT_URL:
+        print(f"[*] Using the LinkedIn stand-in at {LINKEDIN_URL}, no login needed.")
+        return new_session(STANDIN_COOKIES)
+
+    cookies = store.load() if store else None
+    if cookies:
+        session = new_session(cookies)
+        if session_valid(session, proxies):
+            print(f"[*] Reusing the LinkedIn session saved in {store.path}")
+            return session
+        print("[*] The saved LinkedIn session expired, log in again.")
+
     driver = get_webdriver()
 
     if driver is None:
@@ -322,10 +588,20 @@ def login():
     selenium_cookies = driver.cookies(as_dict=True)
     driver.close()
 
-    # Initialize and return a requests session
+    cookies = {cookie['name']: cookie['value'] for cookie in selenium_cookies}
+    if store:
+        store.save(cookies)
+
+    return new_session(cookies)
+
+
+def new_session(cookies):
+    """Returns a requests session with the given cookies and the headers LinkedIn wants."""
+    # Like the browser stack, requests is only imported once there is something to request
+    import requests
     session = requests.Session()
-    for cookie in selenium_cookies:
-        session.cookies.set(cookie['name'], cookie['value'])
+    for name, value in cookies.items():
+        session.cookies.set(name, value)
 
     # Add headers required for this tool to function
     mobile_agent = ('Mozilla/5.0 (Linux; U; Android 4.4.2; en-us; SCH-I535 '
@@ -351,18 +627,154 @@ def set_csrf_token(session):
     return session
 
 
-def get_company_info(name, session):
+def session_valid(session, proxies=None):
+    """Checks a session is still logged in, with one small request for the member's own profile."""
+    import requests
+    try:
+        response = session.get(f'{LINKEDIN_URL}/voyager/api/me', proxies=proxies, verify=not proxies,
+                               allow_redirects=False, timeout=10)
+    except requests.exceptions.RequestException:
+        return False
+    return response.status_code == 200
+
+
+class SessionStore():
+    """
+    Keeps the cookies of a LinkedIn login between runs, in a file only the user
+    can read. The CSRF token is the JSESSIONID cookie, so it's saved with them.
+
+    A fresh store never loads the saved session, but still saves the next one.
+    """
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self.fresh = fresh
+
+    def load(self):
+        """Returns the saved cookies, or None if there are none worth trying."""
+        if self.fresh:
+            return None
+        try:
+            with open(self.path, encoding='utf-8') as infile:
+                cookies = json.load(infile)['cookies']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return cookies if isinstance(cookies, dict) and 'JSESSIONID' in cookies else None
+
+    def save(self, cookies):
+        """Replaces the saved session, never leaving it readable by others, even half written."""
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # mkstemp makes the file 0600
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.session-')
+        try:
+            with os.fdopen(handle, 'w', encoding='utf-8') as outfile:
+                json.dump({'saved': time.time(), 'cookies': cookies}, outfile)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+class CachedResponse(NamedTuple):
+    """Stands in for a requests.Response, with cached set when the reply comes from the ResponseCache."""
+    status_code: int
+    text: str
+    cached: bool = False
+
+
+class ResponseCache():
+    """
+    On-disk cache of LinkedIn replies, so re-running the same company a little
+    later doesn't fetch everything again.
+
+    Replies are stored zlib-compressed in a SQLite database, keyed by what was asked
+    for (see company_key and search_key), and by LINKEDIN_URL when that points at a
+    stand-in so its replies never mix with LinkedIn's. Entries older than ttl
+    seconds are never returned, and once the database holds more than max_bytes of
+    replies the oldest ones are evicted. Only good replies should be stored.
+    """
+    def __init__(self, cache_dir, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        # Replies hold employee names, so only the owner may read them. The chmod
+        # covers databases created world readable by earlier versions.
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        path = os.path.join(cache_dir, 'responses.sqlite')
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses'
+                        ' (key TEXT PRIMARY KEY, created REAL, body BLOB)')
+        self.evict()
+
+    @staticmethod
+    def company_key(name):
+        """Key of a company info lookup, by universalName."""
+        return json.dumps(['company', name] + ([LINKEDIN_URL] if LINKEDIN_URL != LINKEDIN_DEFAULT_URL else []))
+
+    @staticmethod
+    def search_key(company_id, page, region, keyword):
+        """Key of a search results page."""
+        return json.dumps(['search', company_id, page, region, keyword]
+                          + ([LINKEDIN_URL] if LINKEDIN_URL != LINKEDIN_DEFAULT_URL else []))
+
+    def get(self, key):
+        """Returns the cached reply text for a key, or None."""
+        with self.lock:
+            row = self.db.execute('SELECT body FROM responses WHERE key = ? AND created > ?',
+                                  (key, time.time() - self.ttl)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, key, text):
+        """Stores the reply text for a key."""
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                            (key, time.time(), zlib.compress(text.encode('utf-8'))))
+            self.db.commit()
+
+    def evict(self):
+        """Drops expired replies, then the oldest ones until under max_bytes."""
+        with self.lock:
+            self.db.execute('DELETE FROM responses WHERE created <= ?', (time.time() - self.ttl,))
+            total = 0
+            for key, size in self.db.execute('SELECT key, LENGTH(body) FROM responses'
+                                             ' ORDER BY created DESC').fetchall():
+                total += size
+                if total > self.max_bytes:
+                    self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.db.commit()
+
+    def close(self):
+        """Evicts what is over the limits and closes the database."""
+        self.evict()
+        self.db.close()
+
+
+def get_company_info(name, session, cache=None):
     """Scrapes basic company info.
 
     Note that not all companies fill in this info, so exceptions are provided.
     The company name can be found easily by browsing LinkedIn in a web browser,
     searching for the company, and looking at the name in the address bar.
+
+    When given a ResponseCache, a recent lookup of the same company is reused.
     """
     escaped_name = urllib.parse.quote_plus(name)
 
-    response = session.get(('https://www.linkedin.com'
-                            '/voyager/api/organization/companies?'
-                            'q=universalName&universalName=' + escaped_name))
+    cached = cache.get(cache.company_key(name)) if cache else None
+    if cached is not None:
+        response = CachedResponse(200, cached, True)
+    else:
+        response = session.get((LINKEDIN_URL + '/voyager/api/organization/companies?'
+                                'q=universalName&universalName=' + escaped_name))
 
     if response.status_code == 404:
         print("[!] Could not find that company name. Please double-check LinkedIn and try again.")
@@ -393,6 +805,9 @@ def get_company_info(name, session):
         print(response.text[:200])
         sys.exit()
 
+    if cache and cached is None:
+        cache.put(cache.company_key(name), response.text)
+
     company = response_json["elements"][0]
 
     found_name = company.get('name', "NOT FOUND")
@@ -446,7 +861,8 @@ def set_inner_loops(staff_count, args):
     """
 
     # We will look for 50 names on each loop. So, we set a maximum amount of
-    # loops to the amount of staff / 50 +1 more to catch remainders.
+    # loops to the amount of staff / 50 +1 more to catch remainders. Each search
+    # then stops at the last page it really has, see scrape_pages.
     loops = int((staff_count / 50) + 1)
 
     print(f"[*] Company has {staff_count} profiles to check. Some may be anonymous.")
@@ -481,7 +897,7 @@ def set_inner_loops(staff_count, args):
     return args.depth, args.geoblast
 
 
-def get_results(session, company_id, page, region, keyword):
+def get_results(session, company_id, page, region, keyword, cache=None):
     """Scrapes raw data for processing.
 
     The URL below is what the LinkedIn mobile HTTP site queries when manually
@@ -490,10 +906,13 @@ def get_results(session, company_id, page, region, keyword):
     The mobile site defaults to using a 'count' of 10, but testing shows that
     50 is allowed. This behavior will appear to the web server as someone
     scrolling quickly through all available results.
+
+    When given a ResponseCache, a recent copy of the same page is returned instead
+    as a CachedResponse. Fetched pages are stored by keep_results once parsed.
     """
 
     # Build the base search URL.
-    url = ('https://www.linkedin.com/voyager/api/graphql?variables=('
+    url = (f'{LINKEDIN_URL}/voyager/api/graphql?variables=('
            f'start:{page * 50},'
            f'query:('
            f'{f"keywords:{keyword}," if keyword else ""}'
@@ -506,39 +925,105 @@ def get_results(session, company_id, page, region, keyword):
            '),count:50)'
            '&queryId=voyagerSearchDashClusters.66adc6056cf4138949ca5dcb31bb1749')
 
+    # Reuse a recent copy of this page if we have one.
+    cached = cached_results(cache, company_id, page, region, keyword)
+    if cached is not None:
+        return cached
+
     # Perform the search for this iteration.
-    result = session.get(url)
-    return result
+    return session.get(url, timeout=SEARCH_TIMEOUT)
+
+
+def cached_results(cache, company_id, page, region, keyword):
+    """Returns a recent copy of a search page from cache as a CachedResponse, or None."""
+    if cache:
+        cached = cache.get(cache.search_key(company_id, page, region, keyword))
+        if cached is not None:
+            return CachedResponse(200, cached, True)
+    return None
+
+
+def keep_results(cache, company_id, page, region, keyword, result, parsed):
+    """
+    Stores a search page fetched by get_results in cache, going by the SearchPage
+    parse_results made of it. Only pages with people on them are kept. Errors, the
+    search limit and empty pages are asked for again next time.
+    """
+    if cache and result.status_code == 200 and parsed.employees and not getattr(result, 'cached', False):
+        cache.put(cache.search_key(company_id, page, region, keyword), result.text)
+
+
+class Employee(NamedTuple):
+    """
+    One person found in a search.
+
+    A big run keeps every employee around until the end, so this is a plain tuple
+    rather than a dict. Occupations repeat a lot and are interned by find_employees.
+    """
+    full_name: str
+    occupation: str
+    urn: str = ''
 
 
 def find_employees(result):
     """
     Takes the text response of an HTTP query, converts to JSON, and extracts employee details.
 
-    Returns a list of dictionary items, or False if none found.
+    Returns a list of Employee records, or False if none found.
     """
-    found_employees = []
+    return parse_results(result).employees
+
+
+def search_pages(total):
+    """Returns how many pages of 50 LinkedIn will give for a search with total results."""
+    return -(-min(total, SEARCH_LIMIT) // 50)
+
+
+class SearchPage(NamedTuple):
+    """What we take from a page of search results. error is set when it wasn't JSON."""
+    employees: list
+    total: int
+    upsell: bool = False
+    error: bool = False
+
 
+def parse_results(result):
+    """
+    Does the work of find_employees, also returning the total results of the search
+    from its paging info, and whether we hit the commercial search limit.
+
+    The reply is decoded once, with orjson if available, and only the name, title
+    and profile id of each person are pulled out of it. The search limit is told
+    by the type of the reply's primary filter cluster, or by an empty page that
+    mentions it anywhere, in case LinkedIn moves it.
+
+    Returns a SearchPage, with employees set to False if none were found, and error
+    set if the reply could not be decoded, which is not the end of the search.
+    """
     try:
-        result_json = json.loads(result)
+        result_json = json_loads(result)
     except json.decoder.JSONDecodeError:
         print("\n[!] Yikes! Could not decode JSON when scraping this loop! :(")
-        print("I'm going to bail on scraping names now, but this isn't normal. You should "
+        print("I'm going to bail on scraping this loop now, but this isn't normal. You should "
               "troubleshoot or open an issue.")
         print("Here's the first 200 characters of the HTTP reply which may help in debugging:\n\n")
         print(result[:200])
-        return False
+        return SearchPage(False, 0, error=True)
 
     # Walk the data, being careful to avoid key errors
     data = result_json.get('data', {})
     search_clusters = data.get('searchDashClustersByAll', {})
-    elements = paging = search_clusters.get('elements', [])
+    metadata = search_clusters.get('metadata') or {}
+    if (metadata.get('primaryFilterCluster') or {}).get('type') == 'UPSELL_LIMIT':
+        return SearchPage(False, 0, True)
+
+    elements = search_clusters.get('elements', [])
     paging = search_clusters.get('paging', {})
     total = paging.get('total', 0)
 
     # If we've ended up with empty dicts or zero results left, bail out
     if total == 0:
-        return False
+        return SearchPage(False, 0, "UPSELL_LIMIT" in result)
 
     # The "elements" list is the mini-profile you see when scrolling through a
     # company's employees. It does not have all info on the person, like their
@@ -564,17 +1049,431 @@ def find_employees(result):
             # Some users are missing a primary subtitle
             occupation = entity.get('primarySubtitle', {}).get('text', '') if entity.get('primarySubtitle') else ''
 
-            found_employees.append({'full_name': full_name, 'occupation': occupation})
+            # Keep whatever identifies the profile, it is used to spot the same person
+            # showing up again in another search
+            urn = entity.get('trackingUrn') or entity.get('entityUrn') or ''
 
-    return found_employees
+            found_employees.append(Employee(full_name, sys.intern(occupation), urn))
 
+    return SearchPage(found_employees, total)
 
-def do_loops(session, company_id, outer_loops, args):
+
+class EmployeeIndex():
+    """
+    Remembers the employees found so far, to drop duplicates as each page arrives.
+
+    Geoblast and keyword searches overlap, so the same person can be returned by
+    several of them. People are identified by their LinkedIn URN when the search
+    result carries a real one, and by their cleaned name and occupation otherwise.
+    """
+    def __init__(self):
+        self.seen = set()
+        self.duplicates = 0
+
+    @staticmethod
+    def key(employee):
+        """Returns the identity used to de-duplicate an employee."""
+        if employee.urn.startswith('urn:li:'):
+            return employee.urn
+        return (NameMutator.clean_name(employee.full_name), employee.occupation)
+
+    def add(self, employees):
+        """Returns the employees not seen before, remembering them for next time."""
+        new_employees = []
+        for employee in employees:
+            key = self.key(employee)
+            if key in self.seen:
+                self.duplicates += 1
+                continue
+            self.seen.add(key)
+            new_employees.append(employee)
+        return new_employees
+
+
+class ScrapeJournal():
+    """
+    Append-only record of the search pages scraped so far, so that a run that died
+    half way can be resumed.
+
+    The first line holds the search parameters. Every scraped page adds a line with
+    its outer loop, page number, the employees found on it and the search's total
+    results, and every outer loop that reached the end of its results adds a line
+    marking it done. When resuming, these are loaded back into pages, totals and
+    done. Pages added during a run are only written to the file.
+    """
+    def __init__(self, path, params, resume=False):
+        self.pages = {}
+        self.totals = {}
+        self.done = set()
+
+        if resume and os.path.exists(path):
+            self.load(path, params)
+            self.file = open(path, 'a', encoding='utf-8')
+        else:
+            self.file = open(path, 'w', encoding='utf-8')
+            self.append(params)
+
+    def load(self, path, params):
+        """
+        Reads back a journal, raising ValueError if it was for another search.
+
+        A line cut short by a crash is dropped from the file, along with anything
+        after it.
+        """
+        good = 0
+        with open(path, 'rb+') as infile:
+            for number, line in enumerate(infile):
+                try:
+                    entry = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                good += len(line)
+
+                if number == 0:
+                    if entry != params:
+                        raise ValueError(f"{path} is for another search: {entry}")
+                elif 'done' in entry:
+                    self.done.add(entry['loop'])
+                else:
+                    self.pages[(entry['loop'], entry['page'])] = [
+                        Employee(full_name, sys.intern(occupation), urn)
+                        for full_name, occupation, urn in entry['employees']]
+                    if entry.get('total'):
+                        self.totals[entry['loop']] = entry['total']
+            infile.truncate(good)
+
+    def append(self, entry):
+        """Writes one line, straight to disk."""
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+
+    def add_page(self, loop, page, employees, total=0):
+        """Records the employees found on one page of an outer loop."""
+        self.totals[loop] = total
+        self.append({'loop': loop, 'page': page, 'employees': employees, 'total': total})
+
+    def finish_loop(self, loop):
+        """Records that an outer loop has no more results."""
+        self.done.add(loop)
+        self.append({'loop': loop, 'done': True})
+
+    def close(self):
+        """Closes the journal file."""
+        self.file.close()
+
+
+class RequestPacer():
+    """
+    Decides when the next LinkedIn request may start.
+
+    Requests are spaced at least `floor` seconds apart (the --sleep option) and,
+    when `rate` is set, drawn from a token bucket refilled at `rate` per second
+    that holds up to PACER_BURST requests.
+
+    When LinkedIn throttles or fails a request, retry_delay() says how long to
+    back off before retrying it, and every request waits that long. The spacing
+    also grows with each failure and shrinks back with each success. Used by the
+    CLI and the server, from any thread, so it only does bookkeeping: callers do
+    their own sleeping.
+    """
+    def __init__(self, floor=0, rate=None, retries=RETRIES):
+        self.floor = floor
+        self.rate = rate
+        self.retries = retries
+        self.tokens = PACER_BURST
+        self.refilled = time.monotonic()
+        self.next_start = 0
+        self.extra = 0
+        self.retried = 0
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """Books the next request start, returning how many seconds to wait for it."""
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+
+            if self.rate:
+                self.tokens = min(PACER_BURST, self.tokens + (start - self.refilled) * self.rate)
+                self.refilled = start
+                if self.tokens < 1:
+                    start += (1 - self.tokens) / self.rate
+                    self.refilled = start
+                    self.tokens = 1
+                self.tokens -= 1
+
+            self.next_start = start + max(self.floor, self.extra)
+            return start - now
+
+    @staticmethod
+    def is_transient(status_code):
+        """Tells throttling and server errors apart from replies worth keeping."""
+        return status_code == 429 or status_code >= 500
+
+    def retry_delay(self, status_code, retry_after=None, attempt=0):
+        """
+        Returns how long to wait before retrying a request that failed with
+        status_code, or None when it should not be retried.
+
+        retry_after is the Retry-After header of the reply, in seconds or as a date.
+        """
+        if not self.is_transient(status_code) or attempt >= self.retries:
+            return None
+
+        wait = BACKOFF_BASE * 2 ** attempt
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                try:
+                    import email.utils
+                    wait = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    pass
+        wait = min(max(wait, 0), BACKOFF_MAX)
+
+        with self.lock:
+            self.retried += 1
+            self.extra = min(BACKOFF_MAX, max(self.extra * 2, BACKOFF_BASE))
+            self.next_start = max(self.next_start, time.monotonic() + wait)
+        return wait
+
+    def success(self):
+        """Relaxes the spacing added by earlier failures."""
+        with self.lock:
+            self.extra = self.extra / 2 if self.extra > 0.1 else 0
+
+
+class RunProfile():
+    """
+    Where the time of a run went, for --profile.
+
+    Keeps the wall time of each phase, every search request (page, status,
+    bytes, latency, time held back by pacing), the parse time of every page and the
+    time spent mutating names and writing each output file, and writes them as a
+    JSON report with percentiles. With cprofile_path set, the phases doing the
+    offline work (parsing, mutating and writing) also run under cProfile, dumped to
+    that path. Requests made on the PageFetcher thread are not in there.
+    """
+    def __init__(self, cprofile_path=None):
+        self.started = time.time()
+        self.phases = {}
+        self.requests = []
+        self.parses = []
+        self.files = collections.Counter()
+        self.mutate = 0
+        self.lock = threading.Lock()
+        self.cprofile_path = cprofile_path
+        self.profiler = cProfile.Profile() if cprofile_path else None
+
+    @contextlib.contextmanager
+    def phase(self, name, cprofile=False):
+        """Times a phase of the run, under cProfile too if asked to."""
+        if cprofile and self.profiler:
+            self.profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+            if cprofile and self.profiler:
+                self.profiler.disable()
+
+    def request(self, page, status_code, size, latency, paced, attempt=0):
+        """Records one search request, from any thread."""
+        with self.lock:
+            self.requests.append({'page': page, 'status': status_code, 'bytes': size, 'latency': latency,
+                                  'paced': paced, 'attempt': attempt})
+
+    def parse(self, page, seconds):
+        """Records the parse time of a page."""
+        self.parses.append({'page': page, 'seconds': seconds})
+
+    def writer(self, writer):
+        """Records the mutation and per file write times of a UsernameWriter."""
+        self.files.update(writer.file_times)
+        self.mutate += writer.mutate_time
+
+    @staticmethod
+    def percentiles(values):
+        """Count, mean, max and nearest-rank percentiles of a list of numbers."""
+        if not values:
+            return {'count': 0}
+        values = sorted(values)
+        summary = {'count': len(values), 'mean': sum(values) / len(values), 'max': values[-1]}
+        for percent in (50, 90, 99):
+            summary[f'p{percent}'] = values[max(0, -(-percent * len(values) // 100) - 1)]
+        return summary
+
+    def report(self):
+        """Returns the report as a dict."""
+        statuses = collections.Counter(str(request['status']) for request in self.requests)
+        return {
+            'started': self.started,
+            'total': time.time() - self.started,
+            'phases': self.phases,
+            'requests': {
+                'count': len(self.requests),
+                'statuses': dict(statuses),
+                'bytes': sum(request['bytes'] for request in self.requests),
+                'paced': sum(request['paced'] for request in self.requests),
+                'latency': self.percentiles([request['latency'] for request in self.requests]),
+                'log': self.requests,
+            },
+            'parse': self.percentiles([parse['seconds'] for parse in self.parses]),
+            'mutate': self.mutate,
+            'files': dict(self.files),
+        }
+
+    def write(self, path):
+        """Writes the report, and the cProfile stats if there are any."""
+        with open(path, 'w', encoding='utf-8') as outfile:
+            json.dump(self.report(), outfile, indent=2)
+        if self.profiler:
+            self.profiler.dump_stats(self.cprofile_path)
+
+
+class PageTiming(NamedTuple):
+    """How long a search page took to fetch, and how long we waited on it."""
+    page: int
+    fetch: float
+    waited: float
+
+
+class PageFetcher():
+    """
+    Fetches search pages in the background, ahead of the page being processed.
+
+    Up to `ahead` requests are in flight while the caller parses and writes the
+    current page, so that work overlaps with network latency. Requests are started
+    when the RequestPacer allows, and throttled, failed or cut short replies are
+    retried as it says. With ahead set to 0, pages are fetched one by one when
+    asked for. Every request is recorded in profile, a RunProfile, if given.
+    """
+    def __init__(self, session, company_id, cache=None, pacer=None, ahead=1, profile=None):
+        self.session = session
+        self.company_id = company_id
+        self.cache = cache
+        self.pacer = pacer or RequestPacer()
+        self.ahead = ahead
+        self.profile = profile
+        import concurrent.futures
+        self.executor = concurrent.futures.ThreadPoolExecutor(ahead) if ahead else None
+        self.timings = []
+        self.closed = threading.Event()
+
+    def pause(self, seconds):
+        """Waits seconds, or less if the fetcher is closed meanwhile. Returns True if it was."""
+        return self.closed.wait(seconds)
+
+    def get(self, page, region, keyword):
+        """
+        Fetches one page, retrying transient failures. A connection error that
+        outlasts the retries is returned as an HTTP 599 reply. Raises CancelledError
+        if the fetcher is closed before it's done.
+        """
+        import concurrent.futures
+        import requests
+
+        # Pages from the cache aren't requests, so they don't wait on the pacer
+        cached = cached_results(self.cache, self.company_id, page, region, keyword)
+        if cached is not None:
+            return cached, 0
+
+        pacer = self.pacer
+        for attempt in range(pacer.retries + 1):
+            paced = pacer.delay()
+            if self.pause(paced):
+                raise concurrent.futures.CancelledError()
+            started = time.monotonic()
+            try:
+                result = get_results(self.session, self.company_id, page, region, keyword)
+            except requests.exceptions.RequestException as error:
+                if self.profile:
+                    self.profile.request(page, type(error).__name__, 0, time.monotonic() - started, paced, attempt)
+                wait = pacer.retry_delay(599, None, attempt)
+                if wait is None:
+                    # Give up on this search like after a 5xx, rather than the whole run
+                    print(f"\n[!] {type(error).__name__} on loop {page + 1}, giving up on it")
+                    return CachedResponse(599, ''), time.monotonic() - started
+                print(f"\n[!] {type(error).__name__} on loop {page + 1}, retrying in {wait:.0f}s")
+                continue
+
+            if self.profile:
+                size = len(result.content) if hasattr(result, 'content') else len(result.text.encode())
+                self.profile.request(page, result.status_code, size, time.monotonic() - started, paced, attempt)
+
+            # A good reply that doesn't end like JSON was cut short
+            status_code = result.status_code
+            if status_code == 200 and not result.text.rstrip().endswith('}'):
+                status_code = 599
+
+            wait = pacer.retry_delay(status_code, getattr(result, 'headers', {}).get('Retry-After'), attempt)
+            if wait is None:
+                break
+            print(f"\n[!] Got an HTTP {status_code} on loop {page + 1}, retrying in {wait:.0f}s")
+
+        if result.status_code == 200:
+            pacer.success()
+        return result, time.monotonic() - started
+
+    def fetch(self, pages, region, keyword, known=True):
+        """
+        Yields (page, result, timing) for the given page numbers, in order.
+
+        Pages already requested ahead are dropped when the caller stops early. When
+        the number of pages isn't known yet, the first page is fetched on its own,
+        so pages is only read further once the caller has seen how many there are.
+        """
+        pages = iter(pages)
+        pending = collections.deque()
+        try:
+            while True:
+                # Keep the next few pages in flight
+                if self.executor and known:
+                    while len(pending) <= self.ahead:
+                        page = next(pages, None)
+                        if page is None:
+                            break
+                        pending.append((page, self.executor.submit(self.get, page, region, keyword)))
+                elif not pending:
+                    page = next(pages, None)
+                    if page is not None:
+                        pending.append((page, None))
+
+                if not pending:
+                    return
+                page, future = pending.popleft()
+
+                waiting = time.monotonic()
+                result, fetch = future.result() if future else self.get(page, region, keyword)
+                timing = PageTiming(page, fetch, time.monotonic() - waiting)
+                self.timings.append(timing)
+                yield page, result, timing
+                known = True
+        finally:
+            for _, future in pending:
+                if future:
+                    future.cancel()
+
+    def close(self):
+        """
+        Drops queued requests. Any in flight finish their current attempt, but
+        don't wait or retry any more.
+        """
+        self.closed.set()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def scrape_pages(session, company_id, outer_loops, args):
     """
     Performs looping where the actual HTTP requests to scrape names occurs
 
-    This is broken into an individual function both to reduce complexity but also to
-    allow a Ctrl-C to happen and to still write the data we've scraped so far.
+    This is a generator, yielding the new employees of each page as soon as it is
+    parsed, so they can be written out before the next page is fetched.
 
     The mobile site used returns proper JSON, which is parsed in this function.
 
@@ -582,16 +1481,39 @@ def do_loops(session, company_id, outer_loops, args):
     using --keywords or --geoblast, both which attempt to bypass the 1,000
     record search limit.
 
-    This function will stop searching if a loop returns 0 new names.
+    This function will stop searching if a loop returns 0 new names. People
+    already found by a previous loop are skipped, see EmployeeIndex.
+
+    Every page is recorded in args.journal. Pages and loops already in there, when
+    resuming a previous run, are yielded first and not fetched again.
+
+    Pages are fetched by a PageFetcher, args.prefetch pages ahead of the one being
+    parsed. args.depth is the most pages a loop may take. The first page of each
+    loop tells how many results its search has, so the loop stops at the last page
+    LinkedIn will actually give, see search_pages.
     """
     # Crafting the right URL is a bit tricky, so currently unnecessary
     # parameters are still being included but set to empty. You will see this
     # below with geoblast and keywords.
-    employee_list = []
-
-    # We want to be able to break here with Ctrl-C and still write the names we have
+    index = EmployeeIndex()
+    journal = args.journal
+    total = 0
+
+    # Start from whatever a previous run already found
+    for employees in journal.pages.values():
+        new_employees = index.add(employees)
+        total += len(new_employees)
+        yield new_employees
+    if journal.pages:
+        print(f"[*] Resuming with {total} names from {len(journal.pages)} pages already scraped.")
+
+    pacer = RequestPacer(args.sleep, args.rate, args.retries)
+    fetcher = PageFetcher(session, company_id, args.cache, pacer, args.prefetch, args.profile)
     try:
         for current_loop in outer_loops:
+            if current_loop in journal.done:
+                continue
+
             if args.geoblast:
                 region_name, region_id = list(GEO_REGIONS.items())[current_loop]
                 current_region = region_id
@@ -605,13 +1527,19 @@ def do_loops(session, company_id, outer_loops, args):
                 current_region = ''
                 current_keyword = ''
 
-            # This is the inner loop. It will search results 50 at a time.
-            for page in range(0, args.depth):
-                new_names = 0
-
+            # This is the inner loop. It will search results 50 at a time, up to
+            # the number of pages the search has once we know it.
+            budget = args.depth
+            if current_loop in journal.totals:
+                budget = min(budget, search_pages(journal.totals[current_loop]))
+            pages = (page for page in range(0, args.depth)
+                     if page < budget and (current_loop, page) not in journal.pages)
+
+            started = time.monotonic()
+            fetched = fetcher.fetch(pages, current_region, current_keyword, current_loop in journal.totals)
+            for done, (page, result, timing) in enumerate(fetched, 1):
                 sys.stdout.flush()
                 sys.stdout.write(f"[*] Scraping results on loop {str(page+1)}...    ")
-                result = get_results(session, company_id, page, current_region, current_keyword)
 
                 if result.status_code != 200:
                     print(f"\n[!] Yikes, got an HTTP {result.status_code}. This is not normal")
@@ -619,99 +1547,468 @@ def do_loops(session, company_id, outer_loops, args):
                     break
 
                 # Commercial Search Limit might be triggered
-                if "UPSELL_LIMIT" in result.text:
+                parsing = time.perf_counter()
+                parsed = parse_results(result.text)
+                found_employees, results = parsed.employees, parsed.total
+                if args.profile:
+                    args.profile.parse(page, time.perf_counter() - parsing)
+                keep_results(args.cache, company_id, page, current_region, current_keyword, result, parsed)
+                if parsed.upsell:
                     sys.stdout.write('\n')
                     print("[!] You've hit the commercial search limit! "
                           "Try again on the 1st of the month. Sorry. :(")
                     break
 
-                found_employees = find_employees(result.text)
+                # A broken reply isn't the end of the search, so --resume asks for it again
+                if parsed.error:
+                    break
 
                 if not found_employees:
                     sys.stdout.write('\n')
                     print("[*] We have hit the end of the road! Moving on...")
+                    journal.finish_loop(current_loop)
                     break
 
-                new_names += len(found_employees)
-                employee_list.extend(found_employees)
+                journal.add_page(current_loop, page, found_employees, results)
+                new_employees = index.add(found_employees)
+                total += len(new_employees)
+                budget = min(budget, search_pages(results))
 
-                sys.stdout.write(f"    [*] Added {str(new_names)} new names. "
-                                 f"Running total: {str(len(employee_list))}"
+                # Time left, going by the pages of this loop so far
+                left = sum(1 for later in range(page + 1, budget) if (current_loop, later) not in journal.pages)
+                eta = (time.monotonic() - started) / done * left
+
+                sys.stdout.write(f"    [*] Page {page + 1} of {budget}, about {eta:.0f}s left. "
+                                 f"Added {str(len(new_employees))} new names, "
+                                 f"{str(len(found_employees) - len(new_employees))} duplicates. "
+                                 f"Running total: {str(total)} "
+                                 f"(fetched in {timing.fetch:.2f}s, waited {timing.waited:.2f}s)"
                                  "              \r")
+                yield new_employees
 
-                # If the user has defined a sleep between loops, we take a little
-                # nap here.
-                time.sleep(args.sleep)
+                # The last page of the search is the end of the road as well
+                if page + 1 >= budget < args.depth:
+                    sys.stdout.write('\n')
+                    print("[*] That was the last page of this search! Moving on...")
+                    journal.finish_loop(current_loop)
+                    break
+    finally:
+        fetcher.close()
+
+
+def do_loops(session, company_id, outer_loops, args):
+    """
+    Runs scrape_pages to the end and returns all the employees found.
+
+    This is broken into an individual function both to reduce complexity but also to
+    allow a Ctrl-C to happen and to still write the data we've scraped so far.
+    """
+    employee_list = []
+
+    # We want to be able to break here with Ctrl-C and still write the names we have
+    try:
+        for employees in scrape_pages(session, company_id, outer_loops, args):
+            employee_list.extend(employees)
     except KeyboardInterrupt:
         print("\n\n[!] Caught Ctrl-C. Breaking loops and writing files")
 
     return employee_list
 
 
-def write_lines(employees, name_func, domain, outfile):
+def stream_files(session, company_id, outer_loops, args):
+    """
+    Scrapes and writes the output files as it goes, page by page.
+
+    Each page is mutated and written out as soon as it is parsed, so only one page
+    is held at a time and a run that dies leaves what it got so far on disk.
+    Returns the number of employees written.
+    """
+    written = 0
+    with OutputWriter(args.company, args.domain, args.output, args.formats) as writer:
+        # We want to be able to break here with Ctrl-C and still keep the names we have
+        try:
+            for employees in scrape_pages(session, company_id, outer_loops, args):
+                writer.write(employees)
+                writer.flush()
+                written += len(employees)
+        except KeyboardInterrupt:
+            print("\n\n[!] Caught Ctrl-C. Breaking loops and closing files")
+
+    if args.profile:
+        args.profile.writer(writer)
+    return written
+
+
+class UsernameWriter():
     """
-    Helper function to mutate names and write to an outfile
+    Writes names to all the username files in a single pass.
 
-    Needs to be called with a string variable in name_func that matches the class method
-    name in the NameMutator class.
+    Each name is parsed once by parse_name, and every username format is rendered
+    from that one parsed name by the UsernameFormats. Lines are buffered per file
+    and written out in bulk every flush_every names, as well as when the writer is
+    closed. Files are named {prefix}-{format name}.txt.
+
+    The time spent writing each file is kept in file_times, by file name, and the
+    time spent parsing and mutating names in mutate_time.
+    """
+    def __init__(self, prefix, domain, formats=DEFAULT_FORMATS, flush_every=5000):
+        self.domain = domain
+        self.formats = formats
+        self.flush_every = flush_every
+        self.pending = 0
+
+        self.userfiles = [open(f'{prefix}-{name}.txt', 'w', encoding='utf-8')
+                          for name in formats.names]
+        self.user_lines = [[] for _ in self.userfiles]
+        self.file_times = collections.Counter()
+        self.mutate_time = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_names(self, full_names):
+        """Mutates and buffers raw full names, flushing when enough are pending."""
+        started = time.perf_counter()
+        domain = self.domain
+        mutate = self.formats.mutate
+        for full_name in full_names:
+            name = parse_name(full_name)
+            if name:
+                usernames = mutate(name['first'], name['second'], name['last'])
+                for lines, names in zip(self.user_lines, usernames):
+                    for username in names:
+                        lines.append(username + domain + '\n')
+
+            self.pending += 1
+            if self.pending >= self.flush_every:
+                flushing = time.perf_counter()
+                self.flush()
+                started += time.perf_counter() - flushing
+        self.mutate_time += time.perf_counter() - started
+
+    def write_file(self, outfile, lines):
+        """Writes buffered lines to a file, keeping the time it took in file_times."""
+        started = time.perf_counter()
+        outfile.write(''.join(lines))
+        outfile.flush()
+        lines.clear()
+        self.file_times[os.path.basename(outfile.name)] += time.perf_counter() - started
+
+    def flush(self):
+        """Writes out everything buffered so far."""
+        for outfile, lines in zip(self.userfiles, self.user_lines):
+            self.write_file(outfile, lines)
+        self.pending = 0
+
+    def close(self):
+        """Flushes and closes all the output files."""
+        self.flush()
+        for outfile in self.userfiles:
+            outfile.close()
+
+
+class OutputWriter(UsernameWriter):
     """
-    for employee in employees:
-        mutator = NameMutator(employee["full_name"])
-        if mutator.name:
-            for name in getattr(mutator, name_func)():
-                outfile.write(name + domain + '\n')
+    Writes employees to all the output files in a single pass: raw names, metadata
+    and every username format.
+    """
+    def __init__(self, company, domain, out_dir, formats=DEFAULT_FORMATS, flush_every=5000):
+        # Check for and create an output directory to store the files.
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        self.rawnames = open(f'{out_dir}/{company}-rawnames.txt', 'w', encoding='utf-8')
+        self.metadata = open(f'{out_dir}/{company}-metadata.txt', 'w', encoding='utf-8')
+        self.metadata.write('full_name,occupation\n')
+        self.raw_lines = []
+        self.meta_lines = []
+
+        super().__init__(f'{out_dir}/{company}', domain, formats, flush_every)
+
+    def write(self, employees):
+        """Mutates and buffers a batch of employees, flushing when enough are pending."""
+        for employee in employees:
+            self.raw_lines.append(employee.full_name + '\n')
+            self.meta_lines.append(employee.full_name + ',' + employee.occupation + '\n')
+        self.write_names([employee.full_name for employee in employees])
+
+    def flush(self):
+        """Writes out everything buffered so far."""
+        self.write_file(self.rawnames, self.raw_lines)
+        self.write_file(self.metadata, self.meta_lines)
+        super().flush()
 
+    def close(self):
+        """Flushes and closes all the output files."""
+        super().close()
+        self.rawnames.close()
+        self.metadata.close()
 
-def write_files(company, domain, employees, out_dir):
+
+def write_files(company, domain, employees, out_dir, formats=DEFAULT_FORMATS):
     """Writes data to various formatted output files.
 
     After scraping and processing is complete, this function formats the raw
     names into common username formats and writes them into a directory called
     li2u-output unless specified.
 
-    See in-line comments for decisions made on handling special cases.
+    All the files are filled together by an OutputWriter, see USERNAME_FORMATS for
+    the formats that are written by default.
     """
+    with OutputWriter(company, domain, out_dir, formats) as writer:
+        writer.write(employees)
 
-    # Check for and create an output directory to store the files.
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
 
-    # Write out all the raw and mutated names to files
-    with open(f'{out_dir}/{company}-rawnames.txt', 'w', encoding='utf-8') as outfile:
-        for employee in employees:
-            outfile.write(employee['full_name'] + '\n')
+def output_files(company, domain, employees, formats=DEFAULT_FORMATS, batch_size=5000):
+    """
+    Yields the name of every file write_files writes, with a function rendering
+    its text, batch_size employees at a time. Files are rendered one after the
+    other, for sending them somewhere else than to disk.
+    """
+    def batches():
+        for start in range(0, len(employees), batch_size):
+            yield employees[start:start + batch_size]
+
+    def rawnames():
+        for batch in batches():
+            yield ''.join([employee.full_name + '\n' for employee in batch])
+
+    def metadata():
+        yield 'full_name,occupation\n'
+        for batch in batches():
+            yield ''.join([employee.full_name + ',' + employee.occupation + '\n' for employee in batch])
+
+    def usernames(index):
+        mutate = formats.mutate
+        for batch in batches():
+            lines = []
+            for employee in batch:
+                name = parse_name(employee.full_name)
+                if name:
+                    for username in mutate(name['first'], name['second'], name['last'])[index]:
+                        lines.append(username + domain + '\n')
+            yield ''.join(lines)
+
+    yield f'{company}-rawnames.txt', rawnames
+    yield f'{company}-metadata.txt', metadata
+    for index, name in enumerate(formats.names):
+        yield f'{company}-{name}.txt', functools.partial(usernames, index)
+
+
+class NameColumns():
+    """
+    Split names of a batch of employees, held as NumPy string arrays.
 
-    with open(f'{out_dir}/{company}-metadata.txt', 'w', encoding='utf-8') as outfile:
-        outfile.write('full_name,occupation\n')
-        for employee in employees:
-            outfile.write(employee['full_name'] + ',' + employee["occupation"] + '\n')
+    Names are split with the usual parse_name rules and people without a first and
+    last name are dropped, like NameMutator does. render() then builds a username
+    format for the whole batch at once with vectorized concatenation and slicing.
+    """
+    def __init__(self, full_names):
+        import numpy
+        self.numpy = numpy
+
+        parts = [name for name in map(parse_name, full_names) if name]
+        first = numpy.array([name['first'] for name in parts], dtype=str)
+        second = numpy.array([name['second'] for name in parts], dtype=str)
+        last = numpy.array([name['last'] for name in parts], dtype=str)
+
+        # Casting to a one character string keeps the initial, empty stays empty
+        self.columns = {'first': first, 'f': first.astype('<U1'),
+                        'second': second, 's': second.astype('<U1'),
+                        'last': last, 'l': last.astype('<U1')}
+        self.has_second = second != ''
+
+    def __len__(self):
+        return len(self.has_second)
+
+    def concat(self, template, columns):
+        """Renders a template once per row from the given columns."""
+        add = self.numpy.char.add
+        result = self.numpy.full(len(self), '', dtype='<U1')
+        for literal, field in parse_format(template):
+            if literal:
+                result = add(result, literal)
+            if field:
+                result = add(result, columns[field])
+        return result
+
+    def render(self, template, suffix=''):
+        """
+        Returns the usernames of a template as one string, in the same order as
+        OutputWriter writes them, each followed by suffix.
+        """
+        numpy = self.numpy
+        usernames = self.concat(template, self.columns)
+
+        if expands_second(template):
+            columns = dict(self.columns, last=self.columns['second'], l=self.columns['s'])
+            others = self.concat(template, columns)
+
+            # Interleave each row with its second name variant, when it has a different one
+            keep = numpy.stack([numpy.ones(len(self), dtype=bool),
+                                self.has_second & (others != usernames)], axis=1).reshape(-1)
+            # Either one can be the wider, so both are cast to the wider of the two
+            width = numpy.result_type(usernames, others)
+            usernames = numpy.stack([usernames.astype(width), others.astype(width)], axis=1).reshape(-1)[keep]
 
-    with open(f'{out_dir}/{company}-flast.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'f_last', domain, outfile)
+        # Fixed-width arrays are UTF-32 code points padded with NULs, which never
+        # show up in a username. Dropping them joins every line in one go.
+        lines = numpy.char.add(usernames, suffix)
+        data = lines.view(numpy.uint32)
+        return data[data != 0].tobytes().decode(f'utf-32-{sys.byteorder[0]}e')
 
-    with open(f'{out_dir}/{company}-f.last.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'f_dot_last', domain, outfile)
 
-    with open(f'{out_dir}/{company}-firstl.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'first_l', domain, outfile)
+def write_files_columnar(company, domain, employees, out_dir, formats=DEFAULT_FORMATS,
+                         batch_size=100000):
+    """Writes the same files as write_files, building usernames as NumPy columns.
 
-    with open(f'{out_dir}/{company}-first.last.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'first_dot_last', domain, outfile)
+    Meant for big offline jobs. Employees are handled batch_size at a time to keep
+    the string arrays to a reasonable size. Needs NumPy.
+    """
+    with OutputWriter(company, domain, out_dir, formats) as writer:
+        for start in range(0, len(employees), batch_size):
+            batch = employees[start:start + batch_size]
+            writer.rawnames.write(''.join([employee.full_name + '\n' for employee in batch]))
+            writer.metadata.write(''.join([employee.full_name + ',' + employee.occupation + '\n'
+                                           for employee in batch]))
+
+            columns = NameColumns([employee.full_name for employee in batch])
+            for outfile, template in zip(writer.userfiles, formats.templates):
+                outfile.write(columns.render(template, domain + '\n'))
 
-    with open(f'{out_dir}/{company}-first.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'first', domain, outfile)
 
-    with open(f'{out_dir}/{company}-lastf.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'last_f', domain, outfile)
+def split_shards(path, shards):
+    """
+    Splits a text file into byte ranges of whole lines.
+
+    Returns a list of (start, end) offsets, roughly the same size, at most shards
+    of them. Empty files have no ranges.
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return []
+
+    ranges = []
+    with open(path, 'rb') as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = 0
+        for shard in range(1, shards + 1):
+            end = size if shard == shards else data.find(b'\n', size * shard // shards) + 1
+            if end <= start:
+                # Either no line break left, or a single line longer than this shard
+                end = size if end == 0 else start
+            if end > start:
+                ranges.append((start, end))
+                start = end
+            if start == size:
+                break
+    return ranges
+
+
+def read_shard(path, start, end, chunk_size):
+    """
+    Yields the names in one byte range of a rawnames file, a list per chunk.
+
+    The range is read through a memory map chunk_size bytes (cut at line ends) at a
+    time, so memory stays bounded whatever the size of the file.
+    """
+    with open(path, 'rb') as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        while start < end:
+            stop = end if end - start <= chunk_size else data.find(b'\n', start + chunk_size, end) + 1
+            if stop <= start:
+                stop = end
+            lines = data[start:stop].decode('utf-8').split('\n')
+            # Each name is followed by a line break, the last one leaves an empty string
+            if lines[-1] == '':
+                lines.pop()
+            yield [line.rstrip('\r') for line in lines]
+            start = stop
+
+
+def remutate_shard(path, start, end, prefix, domain, templates, columnar=False, chunk_size=1 << 22):
+    """
+    Writes the username files for the names in one byte range of a rawnames file,
+    with NameColumns if columnar is set. Runs in a worker process of remutate_files.
+    """
+    formats = UsernameFormats(templates)
+    if not columnar:
+        with UsernameWriter(prefix, domain, formats) as writer:
+            for names in read_shard(path, start, end, chunk_size):
+                writer.write_names(names)
+        return
+
+    with contextlib.ExitStack() as stack:
+        userfiles = [stack.enter_context(open(f'{prefix}-{name}.txt', 'w', encoding='utf-8'))
+                     for name in formats.names]
+        for names in read_shard(path, start, end, chunk_size):
+            columns = NameColumns(names)
+            for outfile, template in zip(userfiles, formats.templates):
+                outfile.write(columns.render(template, domain + '\n'))
+
+
+def remutate_files(company, domain, out_dir, formats=DEFAULT_FORMATS, processes=None, columnar=False):
+    """Regenerates the username files of a previous run without going online.
+
+    Names are read back from {company}-rawnames.txt, split into shards that are
+    mutated across a pool of processes, and the shard outputs are concatenated in
+    order into the usual per-format files. The raw names and metadata files are
+    left as they are. Output matches what write_files wrote for the same names.
+    With columnar set, shards are mutated as NumPy columns like write_files_columnar.
+    """
+    path = f'{out_dir}/{company}-rawnames.txt'
+    processes = processes or os.cpu_count() or 1
+
+    # A few shards per process keeps the pool busy when some shards are slower
+    shards = split_shards(path, processes * 4)
+
+    with tempfile.TemporaryDirectory(dir=out_dir) as shard_dir:
+        tasks = [(path, start, end, f'{shard_dir}/{index}', domain, formats.templates, columnar)
+                 for index, (start, end) in enumerate(shards)]
+
+        if processes > 1 and len(tasks) > 1:
+            import multiprocessing
+            with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+                pool.starmap(remutate_shard, tasks)
+        else:
+            for task in tasks:
+                remutate_shard(*task)
+
+        for name in formats.names:
+            with open(f'{out_dir}/{company}-{name}.txt', 'wb') as outfile:
+                for index in range(len(tasks)):
+                    with open(f'{shard_dir}/{index}-{name}.txt', 'rb') as shard:
+                        shutil.copyfileobj(shard, outfile)
+
+
+def write_profile(args):
+    """Writes the --profile report, if one was asked for."""
+    if args.profile:
+        args.profile.write(args.profile_path)
+        print(f"\n[*] Profile written to {args.profile_path}", end='')
+        if args.cprofile:
+            print(f"\n[*] cProfile stats written to {args.cprofile}", end='')
 
 
 def main():
     """Main Function"""
     print(BANNER + "\n\n\n")
     args = parse_arguments()
+    profile = args.profile or RunProfile()
+
+    # Offline mode only needs the names from a previous run, no login required.
+    if args.offline:
+        print(f"[*] Regenerating username files from {args.output}/{args.company}-rawnames.txt")
+        with profile.phase('offline', cprofile=True):
+            remutate_files(args.company, args.domain, args.output, args.formats, args.processes, args.columnar)
+        write_profile(args)
+        print(f"\n[*] All done! Check out your lovely new files in {args.output}")
+        return
 
     # Instantiate a session by logging in to LinkedIn.
-    session = login()
+    with profile.phase('login'):
+        session = login(SessionStore(args.session_file, args.fresh_login), args.proxy_dict if args.proxy else None)
 
     # If we can't get a valid session, we quit now. Specific errors are
     # printed to the console inside the login() function.
@@ -723,24 +2020,51 @@ def main():
     if args.proxy:
         print("[!] Using a proxy, ignoring SSL errors. Don't get pwned.")
         session.verify = False
+        import urllib3
         urllib3.disable_warnings(category=urllib3.exceptions.InsecureRequestWarning)
         session.proxies.update(args.proxy_dict)
 
     # Get basic company info
     print("[*] Trying to get company info...")
-    company_id, staff_count = get_company_info(args.company, session)
+    with profile.phase('company_info'):
+        company_id, staff_count = get_company_info(args.company, session, args.cache)
 
     # Define inner and outer loops
     print("[*] Calculating inner and outer loops...")
     args.depth, args.geoblast = set_inner_loops(staff_count, args)
     outer_loops = set_outer_loops(args)
 
-    # Do the actual searching
+    # Keep track of the pages we get, so a dead run can be resumed
+    os.makedirs(args.output, exist_ok=True)
+    journal_path = f'{args.output}/{args.company}-journal.jsonl'
+    try:
+        args.journal = ScrapeJournal(journal_path, {'company': args.company, 'geoblast': args.geoblast,
+                                                    'keywords': args.keywords}, args.resume)
+    except ValueError as error:
+        print(f"[!] Can't resume: {error}")
+        sys.exit()
+
+    # Do the actual searching. Columnar mode works on the whole set at once, the
+    # default writes every page to the files as soon as it gets it.
     print("[*] Starting search.... Press Ctrl-C to break and write files early.\n")
-    employees = do_loops(session, company_id, outer_loops, args)
+    if args.columnar:
+        with profile.phase('scrape', cprofile=True):
+            employees = do_loops(session, company_id, outer_loops, args)
+        with profile.phase('write', cprofile=True):
+            write_files_columnar(args.company, args.domain, employees, args.output, args.formats)
+    else:
+        with profile.phase('scrape', cprofile=True):
+            stream_files(session, company_id, outer_loops, args)
+    args.journal.close()
+
+    for cache, stats in name_cache_stats(args.formats).items():
+        print(f"\n[*] Cached {cache}: {stats.hits} hits, {stats.misses} misses", end='')
+
+    if args.cache:
+        print(f"\n[*] Response cache: {args.cache.hits} hits, {args.cache.misses} misses", end='')
+        args.cache.close()
 
-    # Write the data to some files.
-    write_files(args.company, args.domain, employees, args.output)
+    write_profile(args)
 
     # Time to get hacking.
     print(f"\n\n[*] All done! Check out your lovely new files in {args.output}")
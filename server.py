@@ -1,13 +1,52 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks
-from pydantic import BaseModel
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict
 from typing import List, Optional
 import asyncio
 import aiohttp
+import bisect
+import collections
+import contextlib
+import functools
 import json
+import os
+import tarfile
+import threading
+import time
 import urllib.parse
-from dphelper import DPHelper
+import uuid
+import zipfile
 from fastapi.middleware.cors import CORSMiddleware
 
+from linkedin2username import (CACHE_DIR, CACHE_TTL, LINKEDIN_DEFAULT_URL, LINKEDIN_URL, SESSION_FILE, STANDIN_COOKIES,
+                               CachedResponse, EmployeeIndex, RequestPacer, ResponseCache, SessionStore, UsernameFormats,
+                               keep_results, output_files, parse_name, parse_results, search_pages, write_files)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global CACHE
+    ttl = int(os.environ.get('LI2U_CACHE_TTL', CACHE_TTL))
+    CACHE = ResponseCache(os.environ.get('LI2U_CACHE_DIR', CACHE_DIR), ttl) if ttl > 0 else None
+
+    # Logged in sessions live as long as the app, and are shared by its scrapes
+    store = SessionStore(os.environ.get('LI2U_SESSION_FILE', SESSION_FILE)) if LINKEDIN_URL == LINKEDIN_DEFAULT_URL else None
+    app.state.sessions = SessionPool(store, int(os.environ.get('LI2U_SESSIONS', SESSION_POOL_SIZE)))
+    await app.state.sessions.warm()
+    app.state.jobs = JobQueue(app.state.sessions, int(os.environ.get('LI2U_JOB_WORKERS', JOB_WORKERS)),
+                              int(os.environ.get('LI2U_JOB_QUEUE', JOB_QUEUE_SIZE)))
+    try:
+        yield
+    finally:
+        await app.state.jobs.close()
+        await app.state.sessions.close()
+        if CACHE:
+            CACHE.close()
+            CACHE = None
+
+app = FastAPI(lifespan=lifespan)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allows all origins
@@ -15,7 +54,6 @@ app.add_middleware(
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
 )
-app = FastAPI()
 
 # ... [Constants like BANNER and GEO_REGIONS remain the same]
 
@@ -71,144 +109,170 @@ GEO_REGIONS = {
     "ve": "101490751"
 }
 
-class NameMutator():
-    """
-    This class handles all name mutations.
-
-    Init with a raw name, and then call the individual functions to return a mutation.
-    """
-    def __init__(self, name):
-        self.name = self.clean_name(name)
-        self.name = self.split_name(self.name)
-
-    @staticmethod
-    def clean_name(name):
-        """
-        Removes common punctuation.
-
-        LinkedIn users tend to add credentials to their names to look special.
-        This function is based on what I have seen in large searches, and attempts
-        to remove them.
-        """
-        # Lower-case everything to make it easier to de-duplicate.
-        name = name.lower()
-
-        # Use case for tool is mostly standard English, try to standardize common non-English
-        # characters.
-        name = re.sub("[àáâãäå]", 'a', name)
-        name = re.sub("[èéêë]", 'e', name)
-        name = re.sub("[ìíîï]", 'i', name)
-        name = re.sub("[òóôõö]", 'o', name)
-        name = re.sub("[ùúûü]", 'u', name)
-        name = re.sub("[ýÿ]", 'y', name)
-        name = re.sub("[ß]", 'ss', name)
-        name = re.sub("[ñ]", 'n', name)
-
-        # Get rid of all things in parenthesis. Lots of people put various credentials, etc
-        name = re.sub(r'\([^()]*\)', '', name)
-
-        # The lines below basically trash anything weird left over.
-        # A lot of users have funny things in their names, like () or ''
-        # People like to feel special, I guess.
-        allowed_chars = re.compile('[^a-zA-Z -]')
-        name = allowed_chars.sub('', name)
-
-        # Next, we get rid of common titles. Thanks ChatGPT for the help.
-        titles = ['mr', 'miss', 'mrs', 'phd', 'prof', 'professor', 'md', 'dr', 'mba']
-        pattern = "\\b(" + "|".join(titles) + ")\\b"
-        name = re.sub(pattern, '', name)
-
-        # The line below tries to consolidate white space between words
-        # and get rid of leading/trailing spaces.
-        name = re.sub(r'\s+', ' ', name).strip()
-
-        return name
-
-    @staticmethod
-    def split_name(name):
-        """
-        Takes a name (string) and returns a list of individual name-parts (dict).
-
-        Some people have funny names. We assume the most important names are:
-        first name, last name, and the name right before the last name (if they have one)
-        """
-        # Split on spaces and dashes (included repeated)
-        parsed = re.split(r'[\s-]+', name)
-
-        # Iterate and remove empty strings
-        parsed = [part for part in parsed if part]
-
-        # Discard people without at least a first and last name
-        if len(parsed) < 2:
-            return None
-
-        if len(parsed) > 2:
-            split_name = {'first': parsed[0], 'second': parsed[-2], 'last': parsed[-1]}
-        else:
-            split_name = {'first': parsed[0], 'second': '', 'last': parsed[-1]}
-
-        # Final sanity check to not proceed without first and last name
-        if not split_name['first'] or not split_name['last']:
-            return None
-
-        return split_name
-
-    def f_last(self):
-        """jsmith"""
-        names = set()
-        names.add(self.name['first'][0] + self.name['last'])
-
-        if self.name['second']:
-            names.add(self.name['first'][0] + self.name['second'])
-
-        return names
-
-    def f_dot_last(self):
-        """j.smith"""
-        names = set()
-        names.add(self.name['first'][0] + '.' + self.name['last'])
-
-        if self.name['second']:
-            names.add(self.name['first'][0] + '.' + self.name['second'])
-
-        return names
-
-    def last_f(self):
-        """smithj"""
-        names = set()
-        names.add(self.name['last'] + self.name['first'][0])
+# LinkedIn replies are cached on disk like the CLI does, opened by lifespan. LI2U_CACHE_TTL=0 disables it.
+# Its SQLite calls block, so they run in the threadpool rather than on the event loop.
+CACHE = None
 
-        if self.name['second']:
-            names.add(self.name['second'] + self.name['first'][0])
+# Scrapes take a logged in session from a pool of up to SESSION_POOL_SIZE idle ones.
+# One that sat idle for SESSION_CHECK_SECONDS is checked with LinkedIn first.
+SESSION_POOL_SIZE = 4
+SESSION_CHECK_SECONDS = 300
 
-        return names
-
-    def first_dot_last(self):
-        """john.smith"""
-        names = set()
-        names.add(self.name['first'] + '.' + self.name['last'])
-
-        if self.name['second']:
-            names.add(self.name['first'] + '.' + self.name['second'])
+# Jobs are scraped by JOB_WORKERS at a time. Up to JOB_QUEUE_SIZE more can wait
+# their turn, after that new ones are turned away until there's room. The last
+# JOB_HISTORY finished jobs are kept for their results.
+JOB_WORKERS = 2
+JOB_QUEUE_SIZE = 16
+JOB_HISTORY = 100
+
+# Streamed scrapes send employees as JSON lines or server-sent events.
+STREAM_MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'sse': 'text/event-stream'}
+
+# Archives of a job's username files, made as they are sent.
+ARCHIVE_MEDIA_TYPES = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+
+# Metrics served by /metrics in the Prometheus text format. Recording one is a
+# lock and an addition, nothing next to a request to LinkedIn.
+METRICS = []
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric():
+    """A metric with optional labels, one value per combination of them."""
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        with self.lock:
+            return [(f'{self.name}{self.label_text(labels)}', value) for labels, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name} {value}' for name, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """Counts observations into LATENCY_BUCKETS, rendered cumulative like Prometheus wants."""
+    kind = 'histogram'
+
+    def observe(self, seconds, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            counts[-1] += seconds
+
+    def samples(self):
+        with self.lock:
+            values = {labels: list(counts) for labels, counts in self.values.items()}
+
+        samples = []
+        for labels, counts in sorted(values.items()):
+            total = 0
+            for bucket, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                total += count
+                samples.append((f'{self.name}_bucket{self.label_text(labels, [("le", bucket)])}', total))
+            samples.append((f'{self.name}_sum{self.label_text(labels)}', counts[-1]))
+            samples.append((f'{self.name}_count{self.label_text(labels)}', total))
+        return samples
+
+
+CALL_SECONDS = Histogram('li2u_call_seconds', 'Time spent in login, company lookups, search requests, scrapes and writes.',
+                         ('function',))
+CALL_ERRORS = Counter('li2u_call_errors_total', 'Calls that raised, by function.', ('function',))
+SCRAPES_IN_PROGRESS = Gauge('li2u_scrapes_in_progress', 'Scrapes running right now.')
+WRITES_QUEUED = Gauge('li2u_writes_queued', 'Username files waiting to be written in the background.')
+SEARCH_REPLIES = Counter('li2u_search_replies_total', 'LinkedIn search replies by HTTP status, 599 for connection errors.',
+                         ('status',))
+SEARCH_RETRIES = Counter('li2u_search_retries_total', 'Searches retried after a throttled or failed reply.')
+SEARCH_PACED_SECONDS = Counter('li2u_search_paced_seconds_total', 'Time searches were held back by pacing and backoff.')
+SEARCH_CACHE_HITS = Counter('li2u_search_cache_hits_total', 'Search pages served from the cache.')
+PARSE_SECONDS = Histogram('li2u_parse_seconds', 'Time spent parsing a search page.')
+PAGES = Counter('li2u_pages_total', 'Search pages parsed.')
+JOBS_QUEUED = Gauge('li2u_jobs_queued', 'Jobs waiting for a worker.')
+JOBS = Counter('li2u_jobs_total', 'Jobs finished, by how they ended.', ('status',))
+LOGINS = Counter('li2u_logins_total', 'Sessions logged in, from the saved session or with the browser.', ('source',))
+NAMES_FOUND = Counter('li2u_names_found_total', 'New employees found by searches.')
+
+
+def instrumented(function):
+    """Times every call of a function into CALL_SECONDS and counts the ones that raise."""
+    name = function.__name__
+
+    def observe(start, failed):
+        CALL_SECONDS.observe(time.perf_counter() - start, name)
+        if failed:
+            CALL_ERRORS.inc(name)
+
+    if asyncio.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            start, failed = time.perf_counter(), True
+            try:
+                result = await function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                observe(start, failed)
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start, failed = time.perf_counter(), True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                observe(start, failed)
+    return wrapper
 
-        return names
 
-    def first_l(self):
-        """johns"""
-        names = set()
-        names.add(self.name['first'] + self.name['last'][0])
+timed_write_files = instrumented(write_files)
 
-        if self.name['second']:
-            names.add(self.name['first'] + self.name['second'][0])
 
-        return names
+def write_queued_files(*args):
+    try:
+        timed_write_files(*args)
+    finally:
+        WRITES_QUEUED.dec()
 
-    def first(self):
-        """john"""
-        names = set()
-        names.add(self.name['first'])
 
-        return names
+def render_metrics():
+    return '\n'.join(metric.render() for metric in METRICS) + '\n'
 
 
 class CompanyRequest(BaseModel):
@@ -218,8 +282,12 @@ class CompanyRequest(BaseModel):
     sleep: int = 0
     keywords: Optional[List[str]] = None
     geoblast: bool = False
+    formats: Optional[List[str]] = None
 
 class Employee(BaseModel):
+    # Built straight from the Employee records returned by find_employees
+    model_config = ConfigDict(from_attributes=True)
+
     full_name: str
     occupation: str
 
@@ -227,15 +295,39 @@ class ScrapingResult(BaseModel):
     company: str
     employees: List[Employee]
 
+class JobStatus(BaseModel):
+    # Built straight from a Job
+    model_config = ConfigDict(from_attributes=True)
+
+    id: str
+    company: str
+    status: str
+    loop: int
+    loops: int
+    page: int
+    names: int
+    error: Optional[str] = None
+
+class JobResult(ScrapingResult):
+    status: str
+
 async def get_webdriver():
     """
     Try to get a working Selenium browser driver
+
+    The browser stack is only imported here, like in the CLI.
     """
+    from dphelper import DPHelper
     browser = DPHelper(browser_path=None, HEADLESS=False)
     return browser
 
+@instrumented
 async def login():
-    """Creates a new authenticated session."""
+    """Logs in with the browser, returning the session's cookies."""
+    # A stand-in LinkedIn takes any session, see LI2U_LINKEDIN_URL
+    if LINKEDIN_URL != LINKEDIN_DEFAULT_URL:
+        return STANDIN_COOKIES
+
     driver = await get_webdriver()
 
     if driver is None:
@@ -250,9 +342,11 @@ async def login():
     selenium_cookies = driver.cookies(as_dict=True)
     driver.close()
 
+    return {cookie['name']: cookie['value'] for cookie in selenium_cookies}
+
+def new_session(cookies):
     session = aiohttp.ClientSession()
-    for cookie in selenium_cookies:
-        session.cookie_jar.update_cookies({cookie['name']: cookie['value']})
+    session.cookie_jar.update_cookies(cookies)
 
     mobile_agent = ('Mozilla/5.0 (Linux; U; Android 4.4.2; en-us; SCH-I535 '
                     'Build/KOT49H) AppleWebKit/534.30 (KHTML, like Gecko) '
@@ -261,32 +355,141 @@ async def login():
                             'X-RestLi-Protocol-Version': '2.0.0',
                             'X-Li-Track': '{"clientVersion":"1.13.1665"}'})
 
-    await set_csrf_token(session)
+    set_csrf_token(session, cookies)
 
     return session
 
-async def set_csrf_token(session):
-    csrf_token = session.cookie_jar.filter_cookies('https://www.linkedin.com')['JSESSIONID'].value.replace('"', '')
+def set_csrf_token(session, cookies):
+    csrf_token = cookies['JSESSIONID'].replace('"', '')
     session.headers.update({'Csrf-Token': csrf_token})
     return session
 
+async def session_valid(session: aiohttp.ClientSession):
+    """Checks a session is still logged in, with one small request for the member's own profile."""
+    try:
+        async with session.get(f'{LINKEDIN_URL}/voyager/api/me', allow_redirects=False) as response:
+            return response.status == 200
+    except aiohttp.ClientError:
+        return False
+
+
+class SessionPool():
+    """
+    Logged in sessions for scrapes to borrow, all with the cookies of one login.
+
+    The cookies come from the session store the CLI saves to while LinkedIn takes
+    them, and the browser is only started when it doesn't. A stand-in LinkedIn
+    has no store. A session LinkedIn turns away expires the cookies, so the next
+    one borrowed logs in again.
+    """
+    def __init__(self, store, size=SESSION_POOL_SIZE):
+        self.store = store
+        self.size = size
+        self.cookies = None
+        self.idle = []
+        self.login_lock = asyncio.Lock()
+
+    async def warm(self):
+        """Fills the pool with the saved session if LinkedIn still takes it, never starting a browser."""
+        cookies = self.store.load() if self.store else None
+        if cookies and self.cookies is None:
+            session = new_session(cookies)
+            if await session_valid(session):
+                self.cookies = cookies
+                LOGINS.inc('saved')
+                self.idle.append((session, time.monotonic()))
+            else:
+                await session.close()
+
+    async def login(self):
+        """
+        Sets the cookies from the saved session or, failing that, a browser login,
+        and returns them. They may be expired again by the time the caller uses
+        self.cookies, so callers use what this returns.
+        """
+        async with self.login_lock:
+            if self.cookies is not None:
+                return self.cookies
+            await self.warm()
+            if self.cookies is not None:
+                return self.cookies
+            cookies = await login()
+            if self.store:
+                self.store.save(cookies)
+            self.cookies = cookies
+            LOGINS.inc('browser')
+            return cookies
+
+    async def acquire(self):
+        while self.idle:
+            session, checked = self.idle.pop()
+            if time.monotonic() - checked < SESSION_CHECK_SECONDS or await session_valid(session):
+                return session
+            await self.expire(session)
+
+        cookies = self.cookies
+        if cookies is None:
+            cookies = await self.login()
+        return new_session(cookies)
+
+    async def release(self, session):
+        if session.closed:
+            return
+        if len(self.idle) < self.size:
+            self.idle.append((session, time.monotonic()))
+        else:
+            await session.close()
+
+    async def expire(self, session):
+        """Drops a session LinkedIn turned away, and every other one with the same cookies."""
+        # Unless it's from before the last login
+        if self.cookies and session.headers.get('Csrf-Token') == self.cookies['JSESSIONID'].replace('"', ''):
+            self.cookies = None
+        idle, self.idle = self.idle, []
+        for other, _ in idle + [(session, 0)]:
+            await other.close()
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        """Borrows a session for a scrape, expiring it if LinkedIn turns it away."""
+        session = await self.acquire()
+        try:
+            yield session
+        except HTTPException as error:
+            if error.status_code in (401, 403):
+                await self.expire(session)
+            raise
+        finally:
+            await self.release(session)
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        for session, _ in idle:
+            await session.close()
+
+@instrumented
 async def get_company_info(name: str, session: aiohttp.ClientSession):
     escaped_name = urllib.parse.quote_plus(name)
 
-    async with session.get(f'https://www.linkedin.com/voyager/api/organization/companies?q=universalName&universalName={escaped_name}') as response:
-        if response.status == 404:
-            raise HTTPException(status_code=404, detail="Company not found")
-        if response.status != 200:
-            raise HTTPException(status_code=response.status, detail="Unexpected error when fetching company info")
+    cached = text = await run_in_threadpool(CACHE.get, CACHE.company_key(name)) if CACHE else None
+    if cached is None:
+        async with session.get(f'{LINKEDIN_URL}/voyager/api/organization/companies?q=universalName&universalName={escaped_name}') as response:
+            if response.status == 404:
+                raise HTTPException(status_code=404, detail="Company not found")
+            if response.status != 200:
+                raise HTTPException(status_code=response.status, detail="Unexpected error when fetching company info")
 
-        text = await response.text()
-        if 'mwlite' in text:
-            raise HTTPException(status_code=400, detail="LinkedIn 'lite' version not supported")
+            text = await response.text()
+            if 'mwlite' in text:
+                raise HTTPException(status_code=400, detail="LinkedIn 'lite' version not supported")
 
-        try:
-            response_json = json.loads(text)
-        except json.decoder.JSONDecodeError:
-            raise HTTPException(status_code=500, detail="Could not decode JSON when getting company info")
+    try:
+        response_json = json.loads(text)
+    except json.decoder.JSONDecodeError:
+        raise HTTPException(status_code=500, detail="Could not decode JSON when getting company info")
+
+    if CACHE and cached is None:
+        await run_in_threadpool(CACHE.put, CACHE.company_key(name), text)
 
     company = response_json["elements"][0]
     found_id = company['trackingInfo']['objectUrn'].split(':')[-1]
@@ -308,8 +511,9 @@ def set_inner_loops(staff_count: int, request: CompanyRequest):
         return request.depth, request.geoblast
     return loops, request.geoblast
 
-async def get_results(session: aiohttp.ClientSession, company_id: str, page: int, region: str, keyword: str):
-    url = ('https://www.linkedin.com/voyager/api/graphql?variables=('
+async def get_results(session: aiohttp.ClientSession, company_id: str, page: int, region: str, keyword: str,
+                      pacer: RequestPacer):
+    url = (f'{LINKEDIN_URL}/voyager/api/graphql?variables=('
            f'start:{page * 50},'
            f'query:('
            f'{f"keywords:{keyword}," if keyword else ""}'
@@ -322,68 +526,62 @@ async def get_results(session: aiohttp.ClientSession, company_id: str, page: int
            '),count:50)'
            '&queryId=voyagerSearchDashClusters.66adc6056cf4138949ca5dcb31bb1749')
 
-    async with session.get(url) as result:
-        return await result.text()
-def find_employees(result):
-    """
-    Takes the text response of an HTTP query, converts to JSON, and extracts employee details.
-
-    Returns a list of dictionary items, or False if none found.
-    """
-    found_employees = []
-
-    try:
-        result_json = json.loads(result)
-    except json.decoder.JSONDecodeError:
-        print("\n[!] Yikes! Could not decode JSON when scraping this loop! :(")
-        print("I'm going to bail on scraping names now, but this isn't normal. You should "
-              "troubleshoot or open an issue.")
-        print("Here's the first 200 characters of the HTTP reply which may help in debugging:\n\n")
-        print(result[:200])
-        return False
-
-    # Walk the data, being careful to avoid key errors
-    data = result_json.get('data', {})
-    search_clusters = data.get('searchDashClustersByAll', {})
-    elements = paging = search_clusters.get('elements', [])
-    paging = search_clusters.get('paging', {})
-    total = paging.get('total', 0)
-
-    # If we've ended up with empty dicts or zero results left, bail out
-    if total == 0:
-        return False
-
-    # The "elements" list is the mini-profile you see when scrolling through a
-    # company's employees. It does not have all info on the person, like their
-    # entire job history. It only has some basics.
-    found_employees = []
-    for element in elements:
-        # For some reason it's nested
-        for item_body in element.get('items', []):
-            # Info we want is all under 'entityResult'
-            entity = item_body.get('item', {}).get('entityResult', {})
-
-            # There's some useless entries we need to skip over
-            if not entity:
-                continue
+    if CACHE:
+        key = CACHE.search_key(company_id, page, region, keyword)
+        text = await run_in_threadpool(CACHE.get, key)
+        if text is not None:
+            SEARCH_CACHE_HITS.inc()
+            return CachedResponse(200, text, True)
+
+    # Throttled, failed or cut short replies are retried when the pacer says so. Only
+    # the requests are timed into CALL_SECONDS, the waits go in SEARCH_PACED_SECONDS.
+    for attempt in range(pacer.retries + 1):
+        delay = pacer.delay()
+        SEARCH_PACED_SECONDS.inc(amount=delay)
+        await asyncio.sleep(delay)
+        start = time.perf_counter()
+        try:
+            async with session.get(url) as result:
+                status, retry_after = result.status, result.headers.get('Retry-After')
+                text = await result.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # A connection that keeps failing gives up on the search like a 5xx does
+            CALL_ERRORS.inc('get_results')
+            SEARCH_REPLIES.inc(599)
+            status, text = 599, ''
+            if pacer.retry_delay(599, None, attempt) is None:
+                break
+            SEARCH_RETRIES.inc()
+            continue
+        finally:
+            CALL_SECONDS.observe(time.perf_counter() - start, 'get_results')
 
-            # There is no first/last name fields anymore so we're taking the full name
-            full_name = entity['title']['text'].strip()
+        SEARCH_REPLIES.inc(status)
 
-            # The name may include extras like "Dr" at the start, so we do some basic stripping
-            if full_name[:3] == 'Dr ':
-                full_name = full_name[4:]
+        if status == 200 and not text.rstrip().endswith('}'):
+            wait = pacer.retry_delay(599, None, attempt)
+        else:
+            wait = pacer.retry_delay(status, retry_after, attempt)
+        if wait is None:
+            break
+        SEARCH_RETRIES.inc()
 
-            # Some users are missing a primary subtitle
-            occupation = entity.get('primarySubtitle', {}).get('text', '') if entity.get('primarySubtitle') else ''
+    if status == 200:
+        pacer.success()
 
-            found_employees.append({'full_name': full_name, 'occupation': occupation})
+    return CachedResponse(status, text)
 
-    return found_employees
 
+async def plan_scrape(session: aiohttp.ClientSession, request: CompanyRequest):
+    """Looks the company up and sets the request's loops, returning the company id and the outer loops."""
+    company_id, staff_count = await get_company_info(request.company, session)
+    request.depth, request.geoblast = set_inner_loops(staff_count, request)
+    return company_id, set_outer_loops(request)
 
-async def do_loops(session: aiohttp.ClientSession, company_id: str, outer_loops: range, request: CompanyRequest):
-    employee_list = []
+async def scrape_pages(session: aiohttp.ClientSession, company_id: str, outer_loops: range, request: CompanyRequest):
+    """Yields the loop, page and new employees of every search page as it is parsed."""
+    index = EmployeeIndex()
+    pacer = RequestPacer(request.sleep)
 
     for current_loop in outer_loops:
         if request.geoblast:
@@ -397,95 +595,362 @@ async def do_loops(session: aiohttp.ClientSession, company_id: str, outer_loops:
             current_region = ''
             current_keyword = ''
 
-        for page in range(0, request.depth):
-            result = await get_results(session, company_id, page, current_region, current_keyword)
+        # Stop at the last page the search has, once the first one tells us
+        budget = request.depth
+        page = 0
+        while page < budget:
+            result = await get_results(session, company_id, page, current_region, current_keyword, pacer)
 
-            if "UPSELL_LIMIT" in result:
+            # A session LinkedIn turns away fails the scrape, so the pool logs in again
+            if result.status_code in (401, 403):
+                raise HTTPException(status_code=result.status_code, detail="LinkedIn turned the session away")
+            if result.status_code != 200:
                 break
 
-            found_employees = find_employees(result)
+            start = time.perf_counter()
+            parsed = parse_results(result.text)
+            found_employees, total = parsed.employees, parsed.total
+            PARSE_SECONDS.observe(time.perf_counter() - start)
+            PAGES.inc()
+            if CACHE:
+                await run_in_threadpool(keep_results, CACHE, company_id, page, current_region, current_keyword, result, parsed)
 
             if not found_employees:
                 break
 
-            employee_list.extend(found_employees)
-
-            await asyncio.sleep(request.sleep)
+            new_employees = index.add(found_employees)
+            NAMES_FOUND.inc(amount=len(new_employees))
+            yield current_loop, page, new_employees
+            budget = min(budget, search_pages(total))
+            page += 1
 
+@instrumented
+async def do_loops(session: aiohttp.ClientSession, company_id: str, outer_loops: range, request: CompanyRequest):
+    employee_list = []
+    async for _, _, employees in scrape_pages(session, company_id, outer_loops, request):
+        employee_list.extend(employees)
     return employee_list
 
+class Job():
+    """
+    A scrape run by a JobQueue worker. Its employees grow page by page, so they
+    are there to read while it runs and after it was cancelled.
+    """
+    def __init__(self, request: CompanyRequest, formats: UsernameFormats):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.company = request.company
+        self.formats = formats
+        self.status = 'queued'
+        self.loop = self.loops = self.page = 0
+        self.employees = []
+        self.error = None
+        self.task = None
+
+    @property
+    def names(self):
+        return len(self.employees)
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'cancelled', 'failed')
+
+    async def run(self, sessions: SessionPool):
+        SCRAPES_IN_PROGRESS.inc()
+        try:
+            async with sessions.session() as session:
+                company_id, outer_loops = await plan_scrape(session, self.request)
+                self.loops = len(outer_loops)
+                async for loop, page, employees in scrape_pages(session, company_id, outer_loops, self.request):
+                    self.loop, self.page = loop + 1, page + 1
+                    self.employees.extend(employees)
+            self.status = 'done'
+        except asyncio.CancelledError:
+            self.status = 'cancelled'
+        except HTTPException as error:
+            self.status, self.error = 'failed', error.detail
+        except Exception as error:
+            self.status, self.error = 'failed', f'{type(error).__name__}: {error}'
+        finally:
+            SCRAPES_IN_PROGRESS.dec()
+        JOBS.inc(self.status)
+
+    def cancel(self):
+        if self.status == 'queued':
+            self.status = 'cancelled'
+            JOBS.inc(self.status)
+        elif self.task:
+            self.task.cancel()
+
+
+class JobQueue():
+    """
+    Jobs by id, and the workers that run the queued ones in turn.
+
+    Up to size jobs wait in pending. A queued job that is cancelled leaves it
+    straight away, so it doesn't hold a place until a worker gets to it. ready
+    counts the jobs submitted, workers skip the ones gone by then.
+    """
+    def __init__(self, sessions: SessionPool, workers=JOB_WORKERS, size=JOB_QUEUE_SIZE):
+        self.sessions = sessions
+        self.jobs = {}
+        self.size = size
+        self.pending = collections.deque()
+        self.ready = asyncio.Semaphore(0)
+        self.workers = [asyncio.create_task(self.work()) for _ in range(workers)]
+
+    def submit(self, job: Job):
+        """Queues a job, raising a 503 when the queue is full."""
+        if len(self.pending) >= self.size:
+            raise HTTPException(status_code=503, detail="Too many jobs waiting, try again later",
+                                headers={'Retry-After': '60'})
+        self.pending.append(job)
+        self.ready.release()
+        JOBS_QUEUED.inc()
+        self.jobs[job.id] = job
+
+        # Forget the oldest finished jobs
+        finished = [old for old in self.jobs.values() if old.finished]
+        for old in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self.jobs[old.id]
+
+    def get(self, job_id: str):
+        if job_id not in self.jobs:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return self.jobs[job_id]
+
+    def cancel(self, job: Job):
+        """Cancels a job, taking it out of the queue if it hadn't started yet."""
+        if job in self.pending:
+            self.pending.remove(job)
+            JOBS_QUEUED.dec()
+        job.cancel()
+
+    async def work(self):
+        while True:
+            await self.ready.acquire()
+            if not self.pending:
+                continue
+            job = self.pending.popleft()
+            JOBS_QUEUED.dec()
+
+            job.status = 'running'
+            job.task = asyncio.create_task(job.run(self.sessions))
+            try:
+                await asyncio.wait([job.task])
+            except asyncio.CancelledError:
+                job.task.cancel()
+                raise
+            finally:
+                # Cancelled before it even started
+                if job.task.cancelled():
+                    job.status = 'cancelled'
+                    JOBS.inc(job.status)
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+@app.post("/jobs", response_model=JobStatus, status_code=202)
+async def submit_job(request: CompanyRequest):
+    try:
+        formats = UsernameFormats.with_extra(request.formats)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+    job = Job(request, formats)
+    app.state.jobs.submit(job)
+    return job
+
+@app.get("/jobs/{job_id}", response_model=JobStatus)
+async def job_status(job_id: str):
+    return app.state.jobs.get(job_id)
+
+@app.get("/jobs/{job_id}/results", response_model=JobResult)
+async def job_results(job_id: str):
+    job = app.state.jobs.get(job_id)
+    if not job.finished:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}, cancel it for the results so far")
+    return JobResult(company=job.company, status=job.status, employees=job.employees)
+
+@app.delete("/jobs/{job_id}", response_model=JobStatus)
+async def cancel_job(job_id: str):
+    job = app.state.jobs.get(job_id)
+    app.state.jobs.cancel(job)
+    if job.task:
+        await asyncio.wait([job.task])
+    return job
+
+def email_domain(domain: str):
+    """The domain appended to usernames, with its '@' like the CLI adds."""
+    return '@' + domain if domain else ''
+
+def employee_record(employee, formats: UsernameFormats = None, domain: str = ''):
+    """An employee as sent by streams, with their usernames by format name if formats are given."""
+    record = {'full_name': employee.full_name, 'occupation': employee.occupation}
+    if formats:
+        name = parse_name(employee.full_name)
+        usernames = formats.mutate(name['first'], name['second'], name['last']) if name else [()] * len(formats.names)
+        record['usernames'] = {format_name: [username + domain for username in names]
+                               for format_name, names in zip(formats.names, usernames)}
+    return record
+
+def stream_event(kind: str, data: dict, media: str):
+    data = json.dumps(data, ensure_ascii=False)
+    if media == 'sse':
+        return f'event: {kind}\ndata: {data}\n\n'
+    return data + '\n'
+
+async def stream_pages(borrowed, session, company_id, outer_loops, request, formats, media):
+    """
+    Sends the employees of every page as it is parsed, one event each, then a
+    done event. Nothing is kept once a page was sent.
+    """
+    domain = email_domain(request.domain)
+    names = 0
+    SCRAPES_IN_PROGRESS.inc()
+    try:
+        async with borrowed:
+            async for _, _, employees in scrape_pages(session, company_id, outer_loops, request):
+                names += len(employees)
+                yield ''.join(stream_event('employee', employee_record(employee, formats, domain), media)
+                              for employee in employees)
+        yield stream_event('done', {'names': names}, media)
+    except (aiohttp.ClientError, HTTPException) as error:
+        yield stream_event('error', {'error': getattr(error, 'detail', None) or f'{type(error).__name__}: {error}',
+                                     'names': names}, media)
+    finally:
+        SCRAPES_IN_PROGRESS.dec()
+
+@app.post("/scrape/stream")
+async def stream_scrape(request: CompanyRequest, format: str = 'ndjson', usernames: bool = False):
+    """
+    Scrapes like /scrape, streaming employees as NDJSON lines (format=ndjson) or
+    server-sent events (format=sse) as each search page comes in. Every event is
+    {"full_name", "occupation"}, with "usernames" by format name if asked for.
+    The stream ends with a done event, or an error one, with the names sent.
+    """
+    if format not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(STREAM_MEDIA_TYPES)}")
+    try:
+        formats = UsernameFormats.with_extra(request.formats)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+    # Look the company up first, so that failing gets a proper status code. The
+    # stream then keeps the borrowed session until it ends.
+    async with contextlib.AsyncExitStack() as stack:
+        session = await stack.enter_async_context(app.state.sessions.session())
+        company_id, outer_loops = await plan_scrape(session, request)
+        borrowed = stack.pop_all()
+
+    return StreamingResponse(stream_pages(borrowed, session, company_id, outer_loops, request,
+                                          formats if usernames else None, format),
+                             media_type=STREAM_MEDIA_TYPES[format])
+
+class ArchiveBuffer():
+    """Where zipfile writes an archive, emptied every time a chunk is sent."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def zip_archive(files):
+    """Yields a zip of the files, compressing them a chunk at a time."""
+    buffer = ArchiveBuffer()
+    now = time.localtime()[:6]
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, render in files:
+            info = zipfile.ZipInfo(name, now)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with archive.open(info, 'w') as entry:
+                for text in render():
+                    entry.write(text.encode('utf-8'))
+                    if buffer.chunks:
+                        yield buffer.take()
+    yield buffer.take()
+
+def tar_archive(files):
+    """
+    Yields a tar of the files. Tar headers come before the data and hold its
+    size, so every file is rendered twice, once to count its bytes.
+    """
+    now = time.time()
+    written = 0
+    for name, render in files:
+        info = tarfile.TarInfo(name)
+        info.size = sum(len(text.encode('utf-8')) for text in render())
+        info.mtime = now
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        yield header
+        for text in render():
+            yield text.encode('utf-8')
+        padding = -info.size % tarfile.BLOCKSIZE
+        yield tarfile.NUL * padding
+        written += len(header) + info.size + padding
+
+    # Two empty blocks end the archive, which is padded to a whole record like tarfile does
+    end = 2 * tarfile.BLOCKSIZE
+    yield tarfile.NUL * (end + -(written + end) % tarfile.RECORDSIZE)
+
+@app.get("/jobs/{job_id}/archive")
+async def job_archive(job_id: str, kind: str = 'zip'):
+    """
+    Streams a zip (kind=zip) or tar (kind=tar) of the files the CLI would write
+    for the job's employees: raw names, metadata and every username format. It's
+    made on a worker thread as it is sent, nothing is kept on disk.
+    """
+    if kind not in ARCHIVE_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(ARCHIVE_MEDIA_TYPES)}")
+    job = app.state.jobs.get(job_id)
+    if not job.finished:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}, cancel it for the results so far")
+
+    files = output_files(job.company, email_domain(job.request.domain), job.employees, job.formats)
+    archive = zip_archive(files) if kind == 'zip' else tar_archive(files)
+    filename = urllib.parse.quote(f'{job.company}.{kind}')
+    return StreamingResponse(archive, media_type=ARCHIVE_MEDIA_TYPES[kind],
+                             headers={'Content-Disposition': f"attachment; filename*=UTF-8''{filename}"})
+
 @app.post("/scrape", response_model=ScrapingResult)
 async def scrape_linkedin(request: CompanyRequest, background_tasks: BackgroundTasks):
-    async with await login() as session:
-        company_id, staff_count = await get_company_info(request.company, session)
-
-        request.depth, request.geoblast = set_inner_loops(staff_count, request)
-        outer_loops = set_outer_loops(request)
+    try:
+        formats = UsernameFormats.with_extra(request.formats)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
 
-        employees = await do_loops(session, company_id, outer_loops, request)
+    SCRAPES_IN_PROGRESS.inc()
+    try:
+        async with app.state.sessions.session() as session:
+            company_id, outer_loops = await plan_scrape(session, request)
+            employees = await do_loops(session, company_id, outer_loops, request)
+    finally:
+        SCRAPES_IN_PROGRESS.dec()
 
     result = ScrapingResult(company=request.company, employees=employees)
     
     # Add background task to write files
-    background_tasks.add_task(write_files, request.company, request.domain, employees, "output")
+    WRITES_QUEUED.inc()
+    background_tasks.add_task(write_queued_files, request.company, email_domain(request.domain), employees, "output", formats)
 
     return result
 
-def write_lines(employees, name_func, domain, outfile):
-    """
-    Helper function to mutate names and write to an outfile
-
-    Needs to be called with a string variable in name_func that matches the class method
-    name in the NameMutator class.
-    """
-    for employee in employees:
-        mutator = NameMutator(employee["full_name"])
-        if mutator.name:
-            for name in getattr(mutator, name_func)():
-                outfile.write(name + domain + '\n')
-
-
-def write_files(company, domain, employees, out_dir):
-    """Writes data to various formatted output files.
-
-    After scraping and processing is complete, this function formats the raw
-    names into common username formats and writes them into a directory called
-    li2u-output unless specified.
-
-    See in-line comments for decisions made on handling special cases.
-    """
-
-    # Check for and create an output directory to store the files.
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-
-    # Write out all the raw and mutated names to files
-    with open(f'{out_dir}/{company}-rawnames.txt', 'w', encoding='utf-8') as outfile:
-        for employee in employees:
-            outfile.write(employee['full_name'] + '\n')
-
-    with open(f'{out_dir}/{company}-metadata.txt', 'w', encoding='utf-8') as outfile:
-        outfile.write('full_name,occupation\n')
-        for employee in employees:
-            outfile.write(employee['full_name'] + ',' + employee["occupation"] + '\n')
-
-    with open(f'{out_dir}/{company}-flast.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'f_last', domain, outfile)
-
-    with open(f'{out_dir}/{company}-f.last.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'f_dot_last', domain, outfile)
-
-    with open(f'{out_dir}/{company}-firstl.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'first_l', domain, outfile)
-
-    with open(f'{out_dir}/{company}-first.last.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'first_dot_last', domain, outfile)
-
-    with open(f'{out_dir}/{company}-first.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'first', domain, outfile)
-
-    with open(f'{out_dir}/{company}-lastf.txt', 'w', encoding='utf-8') as outfile:
-        write_lines(employees, 'last_f', domain, outfile)
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
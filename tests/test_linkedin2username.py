@@ -1,5 +1,18 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import zlib
+
+import pytest
+import requests
+
 import linkedin2username
-from linkedin2username import NameMutator
+from linkedin2username import Employee, NameMutator, SearchPage
 
 # Test name mutations
 
@@ -157,6 +170,15 @@ def test_clean_name():
     name = "Mr. Cert Dude (OSCP, OSCE)"
     assert mutator.clean_name(name) == "cert dude"
 
+    name = "Ann ((Nested) Paren) Lee"
+    assert mutator.clean_name(name) == "ann paren lee"
+
+    name = "Iñigo Straße-Ångström (he/him)"
+    assert mutator.clean_name(name) == "inigo strasse-angstrom"
+
+    name = "DR.JOHN  Jean-Dr-Paul"
+    assert mutator.clean_name(name) == "drjohn jean--paul"
+
 
 def test_split_name():
     mutator = NameMutator("xxx")
@@ -170,6 +192,63 @@ def test_split_name():
     name = "brian warner is marilyn manson"
     assert mutator.split_name(name) == {"first": "brian", "second": "marilyn", "last": "manson"}
 
+    name = "jean--paul  smith-"
+    assert mutator.split_name(name) == {"first": "jean", "second": "paul", "last": "smith"}
+
+    assert mutator.split_name("cher") is None
+    assert mutator.split_name(" - ") is None
+
+
+def test_name_caches():
+    linkedin2username.parse_name.cache_clear()
+    linkedin2username.DEFAULT_FORMATS.mutate.cache_clear()
+
+    for name in ["Dr. John Smith", "John Smith, PhD", "John Smith", "Dr. John Smith"]:
+        assert NameMutator(name).f_last() == set(["jsmith", ])
+
+    stats = linkedin2username.name_cache_stats()
+    assert stats['names'].hits == 1
+    assert stats['names'].misses == 3
+    assert stats['names'].maxsize == linkedin2username.NAME_CACHE_SIZE
+
+    # The three spellings all split to the same name, so the usernames are only built once
+    assert stats['usernames'].hits == 3
+    assert stats['usernames'].misses == 1
+
+
+def test_compile_format():
+    mutate = linkedin2username.compile_format('{first}_{last}')
+    assert mutate('john', '', 'smith') == ('john_smith',)
+    assert mutate('john', 'davidson', 'smith') == ('john_smith', 'john_davidson')
+    assert mutate('john', 'smith', 'smith') == ('john_smith',)
+
+    mutate = linkedin2username.compile_format('{last}{f}{s}')
+    assert mutate('john', '', 'smith') == ('smithj',)
+    assert mutate('john', 'davidson', 'smith') == ('smithjd',)
+
+    mutate = linkedin2username.compile_format('{{{f}}}')
+    assert mutate('john', '', 'smith') == ('{j}',)
+
+    for template in ['{middle}', '{first!r}', '{first:>5}', '{first', '../{first}']:
+        with pytest.raises(ValueError):
+            linkedin2username.UsernameFormats([template])
+
+    # Formats can't overwrite each other's files, or the other output files
+    for template in ['f{last}', 'rawnames', 'metadata', '{{first}}', 'f{l}ast']:
+        with pytest.raises(ValueError):
+            linkedin2username.UsernameFormats.with_extra([template])
+    with pytest.raises(ValueError, match='both write'):
+        linkedin2username.UsernameFormats(['{first}_{last}', 'first_{last}'])
+
+
+def test_username_formats():
+    formats = linkedin2username.UsernameFormats.with_extra(['{first}_{last}', '{f}{last}'])
+    assert formats.names == ['flast', 'f.last', 'firstl', 'first.last', 'first', 'lastf', 'first_last']
+    assert formats.mutate('john', 'paul', 'smith') == (
+        ('jsmith', 'jpaul'), ('j.smith', 'j.paul'), ('johns', 'johnp'),
+        ('john.smith', 'john.paul'), ('john',), ('smithj', 'paulj'), ('john_smith', 'john_paul'))
+    assert linkedin2username.UsernameFormats.with_extra([]) is linkedin2username.DEFAULT_FORMATS
+
 
 def test_find_employees():
     with open("tests/mock-employee-response", "r") as infile:
@@ -177,10 +256,524 @@ def test_find_employees():
     employees = linkedin2username.find_employees(result)
 
     assert len(employees) == 2
-    assert employees[0] == {'full_name': 'Michael Myers', 'occupation': 'Camp Counsellor'}
-    assert employees[1] == {'full_name': 'Freddy Krueger', 'occupation': 'Babysitter'}
+    assert employees[0] == Employee('Michael Myers', 'Camp Counsellor', 'xxxxx')
+    assert employees[1] == Employee('Freddy Krueger', 'Babysitter', 'xxxxx')
 
     with open("tests/mock-employee-response-last-page", "r") as infile:
         result = infile.read()
     assert not linkedin2username.find_employees(result)
 
+
+def test_write_files(tmp_path):
+    employees = [Employee(TEST_NAMES[1], 'Camp Counsellor'),
+                 Employee(TEST_NAMES[3], ''),
+                 Employee('Cher', 'Singer')]
+    linkedin2username.write_files('acme', '@acme.com', employees, tmp_path)
+
+    assert (tmp_path / 'acme-rawnames.txt').read_text() == \
+        'John Smith\nJohn-Paul Smith-Robinson\nCher\n'
+    assert (tmp_path / 'acme-metadata.txt').read_text() == \
+        ('full_name,occupation\nJohn Smith,Camp Counsellor\n'
+         'John-Paul Smith-Robinson,\nCher,Singer\n')
+
+    def lines(suffix):
+        return sorted((tmp_path / f'acme-{suffix}.txt').read_text().splitlines())
+
+    assert lines('flast') == ['jrobinson@acme.com', 'jsmith@acme.com', 'jsmith@acme.com']
+    assert lines('f.last') == ['j.robinson@acme.com', 'j.smith@acme.com', 'j.smith@acme.com']
+    assert lines('firstl') == ['johnr@acme.com', 'johns@acme.com', 'johns@acme.com']
+    assert lines('first.last') == ['john.robinson@acme.com', 'john.smith@acme.com', 'john.smith@acme.com']
+    assert lines('first') == ['john@acme.com', 'john@acme.com']
+    assert lines('lastf') == ['robinsonj@acme.com', 'smithj@acme.com', 'smithj@acme.com']
+
+    formats = linkedin2username.UsernameFormats.with_extra(['{first}_{last}'])
+    linkedin2username.write_files('acme', '', employees, tmp_path, formats)
+    assert (tmp_path / 'acme-first_last.txt').read_text() == \
+        'john_smith\njohn_robinson\njohn_smith\n'
+
+
+def test_employee_index():
+    index = linkedin2username.EmployeeIndex()
+    page_one = [Employee('John Smith', 'Sales', 'urn:li:member:1'),
+                Employee('John Smith', 'Sales', 'urn:li:member:2'),
+                Employee('Jane Doe', 'IT', 'xxxxx')]
+    assert index.add(page_one) == page_one
+
+    # Same URN, or same cleaned name and occupation when there is no real URN
+    page_two = [Employee('Johnny Smith', 'Sales', 'urn:li:member:1'),
+                Employee('Dr. Jane Doe', 'IT', ''),
+                Employee('Jane Doe', 'HR', '')]
+    assert index.add(page_two) == [page_two[2]]
+    assert index.duplicates == 2
+
+
+def test_write_files_columnar(tmp_path):
+    pytest.importorskip('numpy')
+    employees = [Employee(name, 'Sales') for name in TEST_NAMES.values()]
+    employees += [Employee('Cher', ''),
+                  Employee('John Smith Smith', '')]
+    formats = linkedin2username.UsernameFormats.with_extra(['{first}_{s}_{last}', 'x{f}'])
+
+    linkedin2username.write_files('acme', '@acme.com', employees, tmp_path / 'objects', formats)
+    linkedin2username.write_files_columnar('acme', '@acme.com', employees, tmp_path / 'columns',
+                                           formats, batch_size=3)
+
+    for path in (tmp_path / 'objects').iterdir():
+        assert (tmp_path / 'columns' / path.name).read_text() == path.read_text()
+
+    # A second name longer than every first and last name in its batch
+    employees = [Employee('Al Bartholomewson Li', ''), Employee('Bo Ng', '')]
+    linkedin2username.write_files('long', '@x.com', employees, tmp_path / 'objects')
+    linkedin2username.write_files_columnar('long', '@x.com', employees, tmp_path / 'columns')
+    assert 'abartholomewson@x.com\n' in (tmp_path / 'columns' / 'long-flast.txt').read_text()
+    for path in (tmp_path / 'objects').glob('long-*'):
+        assert (tmp_path / 'columns' / path.name).read_text() == path.read_text()
+
+
+def test_split_shards(tmp_path):
+    path = tmp_path / 'names.txt'
+    path.write_text('a\n' + 'b' * 100 + '\nc\nd\n')
+    shards = linkedin2username.split_shards(path, 4)
+    assert shards[0][0] == 0 and shards[-1][1] == path.stat().st_size
+    assert all(end == next_start for (_, end), (next_start, _) in zip(shards, shards[1:]))
+    assert all(path.read_bytes()[end - 1:end] == b'\n' for _, end in shards)
+
+    path.write_text('')
+    assert linkedin2username.split_shards(path, 4) == []
+
+
+def test_remutate_files(tmp_path, monkeypatch):
+    employees = [Employee(name, 'Sales') for name in TEST_NAMES.values()] * 3
+    employees += [Employee('', ''), Employee('Cher', '')]
+    linkedin2username.write_files('acme', '@acme.com', employees, tmp_path / 'online')
+
+    (tmp_path / 'offline').mkdir()
+    (tmp_path / 'offline' / 'acme-rawnames.txt').write_bytes(
+        (tmp_path / 'online' / 'acme-rawnames.txt').read_bytes())
+    linkedin2username.remutate_files('acme', '@acme.com', tmp_path / 'offline', processes=2)
+
+    for name in linkedin2username.DEFAULT_FORMATS.names:
+        assert (tmp_path / 'offline' / f'acme-{name}.txt').read_text() == \
+            (tmp_path / 'online' / f'acme-{name}.txt').read_text()
+    assert len(list((tmp_path / 'offline').iterdir())) == 7
+
+    # Same again as NumPy columns
+    monkeypatch.setattr(linkedin2username, 'UsernameWriter', None)
+    linkedin2username.remutate_files('acme', '@acme.com', tmp_path / 'offline', processes=1, columnar=True)
+    for name in linkedin2username.DEFAULT_FORMATS.names:
+        assert (tmp_path / 'offline' / f'acme-{name}.txt').read_text() == \
+            (tmp_path / 'online' / f'acme-{name}.txt').read_text()
+
+
+# What LinkedIn replies once the commercial search limit is hit
+UPSELL_REPLY = json.dumps({'data': {'searchDashClustersByAll': {
+    'metadata': {'primaryFilterCluster': {'type': 'UPSELL_LIMIT'}}}}})
+
+
+class FakeSession():
+    """Counts requests and always replies with the same page."""
+    def __init__(self, text, status_code=200):
+        self.reply = linkedin2username.CachedResponse(status_code, text)
+        self.requests = 0
+
+    def get(self, url, timeout=None):
+        self.requests += 1
+        return self.reply
+
+
+def test_response_cache(tmp_path):
+    cache = linkedin2username.ResponseCache(tmp_path)
+    key = cache.search_key('1234', 0, '', 'sales')
+    assert cache.get(key) is None
+    cache.put(key, 'Zoë 🙂')
+    assert cache.get(key) == 'Zoë 🙂'
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+    # Only the owner may read the names in it
+    os.chmod(tmp_path / 'responses.sqlite', 0o644)
+    linkedin2username.ResponseCache(tmp_path / 'private').close()
+    linkedin2username.ResponseCache(tmp_path).close()
+    assert os.stat(tmp_path / 'private').st_mode & 0o777 == 0o700
+    assert os.stat(tmp_path / 'private' / 'responses.sqlite').st_mode & 0o777 == 0o600
+    assert os.stat(tmp_path / 'responses.sqlite').st_mode & 0o777 == 0o600
+
+    # Survives a restart, but not its time to live
+    assert linkedin2username.ResponseCache(tmp_path).get(key) == 'Zoë 🙂'
+    assert linkedin2username.ResponseCache(tmp_path, ttl=-1).get(key) is None
+
+    # Oldest replies go first once over the size limit
+    size = len(zlib.compress(b'0' * 1000))
+    cache = linkedin2username.ResponseCache(tmp_path / 'small', max_bytes=size * 2)
+    for page in range(3):
+        cache.put(cache.search_key('1234', page, '', ''), str(page) * 1000)
+        time.sleep(0.01)
+    cache.evict()
+    assert cache.get(cache.search_key('1234', 0, '', '')) is None
+    assert cache.get(cache.search_key('1234', 2, '', '')) == '2' * 1000
+
+
+def test_get_results_cache(tmp_path):
+    cache = linkedin2username.ResponseCache(tmp_path)
+    with open("tests/mock-employee-response", "r") as infile:
+        session = FakeSession(infile.read())
+
+    def fetch(page):
+        result = linkedin2username.get_results(session, '1234', page, '', '', cache)
+        parsed = linkedin2username.parse_results(result.text)
+        linkedin2username.keep_results(cache, '1234', page, '', '', result, parsed)
+        return result, parsed
+
+    for cached in (False, True):
+        result, parsed = fetch(2)
+        assert (result.status_code, result.cached) == (200, cached)
+        assert len(parsed.employees) == 2
+    assert session.requests == 1
+
+    # Errors, the commercial limit and empty pages are not kept
+    session = FakeSession(UPSELL_REPLY)
+    assert fetch(3)[1].upsell
+    session.reply = linkedin2username.CachedResponse(200, '{"data": {"UPSELL_LIMIT": true}}')
+    assert fetch(3)[1].upsell
+    session.reply = linkedin2username.CachedResponse(200, '{"data": {}}')
+    fetch(3)
+    session.reply = linkedin2username.CachedResponse(429, '')
+    fetch(4)
+    fetch(3)
+    fetch(4)
+    assert session.requests == 6
+
+    # Cached pages don't wait on the pacer
+    fetcher = linkedin2username.PageFetcher(session, '1234', cache, linkedin2username.RequestPacer(5), ahead=0)
+    started = time.monotonic()
+    assert [result.cached for _, result, _ in fetcher.fetch([2, 2, 2], '', '')] == [True] * 3
+    assert time.monotonic() - started < 1 and session.requests == 6
+
+
+class ScriptedSession():
+    """Replies with the given pages in turn, raising the ones that are exceptions."""
+    def __init__(self, *replies):
+        self.replies = [reply if isinstance(reply, Exception) else linkedin2username.CachedResponse(*reply)
+                        for reply in replies]
+        self.requests = 0
+
+    def get(self, url, timeout=None):
+        self.requests += 1
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+def test_scrape_journal(tmp_path):
+    with open("tests/mock-employee-response", "r") as infile:
+        page = infile.read()
+    path = tmp_path / 'uber-journal.jsonl'
+    params = {'company': 'uber', 'geoblast': False, 'keywords': ['sales', 'hr']}
+    args = argparse.Namespace(geoblast=False, keywords=['sales', 'hr'], depth=3, sleep=0, rate=None, retries=0,
+                              prefetch=0, cache=None, profile=None)
+
+    # First run dies with an error half way through the second keyword
+    args.journal = linkedin2username.ScrapeJournal(path, params)
+    session = ScriptedSession((200, page), (200, '{}'), (200, page), (500, ''))
+    assert len(linkedin2username.do_loops(session, '1234', range(2), args)) == 2
+    args.journal.close()
+    with open(path, 'a') as outfile:
+        outfile.write('{"loop": 1, "pa')
+
+    # Resuming only asks for what is missing, and gets the same names back
+    args.journal = linkedin2username.ScrapeJournal(path, params, resume=True)
+    assert set(args.journal.pages) == {(0, 0), (1, 0)}
+    assert args.journal.done == {0}
+    session = ScriptedSession((200, '{}'))
+    employees = linkedin2username.do_loops(session, '1234', range(2), args)
+    args.journal.close()
+    assert session.requests == 1
+    assert employees[0] == Employee('Michael Myers', 'Camp Counsellor', 'xxxxx')
+    assert len(employees) == 2
+
+    journal = linkedin2username.ScrapeJournal(path, params, resume=True)
+    assert journal.done == {0, 1}
+    journal.close()
+    with pytest.raises(ValueError):
+        linkedin2username.ScrapeJournal(path, dict(params, company='lyft'), resume=True)
+
+    # A broken reply doesn't finish its loop, so resuming asks for it again
+    path = tmp_path / 'broken-journal.jsonl'
+    args.journal = linkedin2username.ScrapeJournal(path, params)
+    session = ScriptedSession((200, page), (200, '<html>Oops</html>'), (200, '{}'))
+    assert len(linkedin2username.do_loops(session, '1234', range(2), args)) == 2
+    args.journal.close()
+    args.journal = linkedin2username.ScrapeJournal(path, params, resume=True)
+    assert args.journal.done == {1}
+    session = ScriptedSession((200, '{}'))
+    linkedin2username.do_loops(session, '1234', range(2), args)
+    args.journal.close()
+    assert session.requests == 1 and args.journal.done == {0, 1}
+
+    # So does a connection that keeps failing, and the next keyword is still scraped
+    path = tmp_path / 'failed-journal.jsonl'
+    args.journal = linkedin2username.ScrapeJournal(path, params)
+    session = ScriptedSession(requests.exceptions.ConnectionError(), (200, page), (200, '{}'))
+    assert len(linkedin2username.do_loops(session, '1234', range(2), args)) == 2
+    args.journal.close()
+    assert args.journal.done == {1} and session.requests == 3
+
+
+def test_stream_files(tmp_path):
+    with open("tests/mock-employee-response", "r") as infile:
+        page = infile.read()
+    args = argparse.Namespace(company='uber', domain='@uber.com', output=str(tmp_path / 'stream'),
+                              formats=linkedin2username.DEFAULT_FORMATS, geoblast=False, keywords=False,
+                              depth=3, sleep=0, rate=None, retries=0, prefetch=1, cache=None, profile=None)
+    args.journal = linkedin2username.ScrapeJournal(tmp_path / 'journal.jsonl', {})
+    session = ScriptedSession((200, page), (200, page), (200, '{}'))
+    assert linkedin2username.stream_files(session, '1234', [None], args) == 2
+
+    # Same files as writing everything at the end
+    employees = linkedin2username.find_employees(page)
+    linkedin2username.write_files('uber', '@uber.com', employees, str(tmp_path / 'batch'), args.formats)
+    for name in ['rawnames', 'metadata'] + args.formats.names:
+        with open(tmp_path / 'stream' / f'uber-{name}.txt') as streamed, \
+                open(tmp_path / 'batch' / f'uber-{name}.txt') as batched:
+            assert streamed.read() == batched.read()
+
+    # A run that dies keeps the pages it already got
+    args.output = str(tmp_path / 'dead')
+    args.journal = linkedin2username.ScrapeJournal(tmp_path / 'dead.jsonl', {})
+    session = ScriptedSession((200, page))
+    with pytest.raises(IndexError):
+        linkedin2username.stream_files(session, '1234', [None], args)
+    with open(tmp_path / 'dead' / 'uber-rawnames.txt') as infile:
+        assert infile.read().count('\n') == 2
+
+
+def test_page_fetcher():
+    with open("tests/mock-employee-response", "r") as infile:
+        session = FakeSession(infile.read())
+
+    # Requests run ahead, but stop when the caller does
+    fetcher = linkedin2username.PageFetcher(session, '1234', ahead=1)
+    for page, result, timing in fetcher.fetch(range(5), '', ''):
+        assert result.status_code == 200
+        if page == 1:
+            break
+    fetcher.close()
+    assert [timing.page for timing in fetcher.timings] == [0, 1]
+    assert session.requests <= 3
+
+    # Requests start at least the sleep apart
+    session = FakeSession(session.reply.text)
+    fetcher = linkedin2username.PageFetcher(session, '1234', pacer=linkedin2username.RequestPacer(0.05), ahead=0)
+    started = time.monotonic()
+    assert [page for page, _, _ in fetcher.fetch(range(3), '', '')] == [0, 1, 2]
+    assert time.monotonic() - started >= 0.1
+    assert session.requests == 3
+
+    # Closing stops a request in the background from waiting to retry
+    session = ScriptedSession(*[(429, '')] * 4)
+    fetcher = linkedin2username.PageFetcher(session, '1234', pacer=linkedin2username.RequestPacer(retries=3))
+    future = fetcher.executor.submit(fetcher.get, 0, '', '')
+    while not session.requests:
+        time.sleep(0.01)
+    started = time.monotonic()
+    fetcher.close()
+    fetcher.executor.shutdown(wait=True)
+    assert time.monotonic() - started < 1
+    assert isinstance(future.exception(), concurrent.futures.CancelledError)
+    assert session.requests == 1
+
+
+def test_search_timeout(monkeypatch):
+    # A server that takes the connection but never answers
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    monkeypatch.setattr(linkedin2username, 'LINKEDIN_URL', f'http://127.0.0.1:{listener.getsockname()[1]}')
+    monkeypatch.setattr(linkedin2username, 'SEARCH_TIMEOUT', 0.2)
+
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.Timeout):
+        linkedin2username.get_results(requests.Session(), '1234', 0, '', '')
+    assert time.monotonic() - started < 5
+    listener.close()
+
+
+def test_request_pacer(monkeypatch):
+    pacer = linkedin2username.RequestPacer(rate=10)
+    assert [pacer.delay() for _ in range(linkedin2username.PACER_BURST)] == [0] * linkedin2username.PACER_BURST
+    assert pacer.delay() == pytest.approx(0.1, abs=0.01)
+
+    # Throttling backs off, LinkedIn's Retry-After wins, and retries run out
+    pacer = linkedin2username.RequestPacer(retries=2)
+    assert pacer.retry_delay(429, None, 0) == linkedin2username.BACKOFF_BASE
+    assert pacer.retry_delay(503, None, 1) == linkedin2username.BACKOFF_BASE * 2
+    assert pacer.retry_delay(429, '7', 1) == 7
+    assert pacer.retry_delay(429, '7', 2) is None
+    assert pacer.retry_delay(404, None, 0) is None
+    assert pacer.delay() > 6
+
+    # The fetcher retries throttled and cut short pages, but not the search limit
+    monkeypatch.setattr(linkedin2username.PageFetcher, 'pause', lambda self, seconds: self.closed.is_set())
+    with open("tests/mock-employee-response", "r") as infile:
+        page = infile.read()
+    session = ScriptedSession((429, ''), (200, page[:100]), (200, page), (200, UPSELL_REPLY))
+    fetcher = linkedin2username.PageFetcher(session, '1234', ahead=0)
+    result, _ = fetcher.get(0, '', '')
+    assert result.text == page
+    assert fetcher.pacer.retried == 2
+    result, _ = fetcher.get(1, '', '')
+    assert 'UPSELL_LIMIT' in result.text
+    assert session.requests == 4
+
+
+def test_search_pages(tmp_path):
+    assert [linkedin2username.search_pages(total) for total in (0, 1, 50, 51, 666, 1000, 5000)] == [0, 1, 1, 2, 14, 20, 20]
+
+    # The fixture says 666 results, so only 14 of the 30 pages are asked for
+    with open("tests/mock-employee-response", "r") as infile:
+        session = FakeSession(infile.read())
+    args = argparse.Namespace(geoblast=False, keywords=False, depth=30, sleep=0, rate=None, retries=0,
+                              prefetch=0, cache=None, profile=None)
+    args.journal = linkedin2username.ScrapeJournal(tmp_path / 'journal.jsonl', {})
+    assert len(linkedin2username.do_loops(session, '1234', [0], args)) == 2
+    assert session.requests == 14
+    assert args.journal.totals == {0: 666}
+    assert args.journal.done == {0}
+
+    # Prefetching waits for the first page's total, one-page searches take one request
+    for total, pages in ((666, 14), (40, 1)):
+        session = FakeSession(session.reply.text.replace('"total":666', f'"total":{total}'))
+        args = argparse.Namespace(geoblast=False, keywords=['a', 'b', 'c'], depth=30, sleep=0, rate=None, retries=0,
+                                  prefetch=1, cache=None, profile=None)
+        args.journal = linkedin2username.ScrapeJournal(tmp_path / f'journal-{total}.jsonl', {})
+        linkedin2username.do_loops(session, '1234', range(3), args)
+        assert session.requests == 3 * pages
+
+
+@pytest.mark.parametrize('backend', ['json', 'orjson'])
+def test_parse_results(monkeypatch, backend):
+    monkeypatch.setattr(linkedin2username, 'json_loads', pytest.importorskip(backend).loads)
+    with open("tests/mock-employee-response", "r") as infile:
+        page = linkedin2username.parse_results(infile.read())
+    assert page.employees == [Employee('Michael Myers', 'Camp Counsellor', 'xxxxx'),
+                              Employee('Freddy Krueger', 'Babysitter', 'xxxxx')]
+    assert (page.total, page.upsell) == (666, False)
+
+    assert linkedin2username.parse_results(UPSELL_REPLY) == SearchPage(False, 0, upsell=True)
+    assert linkedin2username.parse_results('{"data": {"UPSELL_LIMIT": true}}') == SearchPage(False, 0, upsell=True)
+    with open("tests/mock-employee-response", "r") as infile:
+        page = linkedin2username.parse_results(infile.read().replace('Babysitter', 'UPSELL_LIMIT'))
+    assert (len(page.employees), page.upsell) == (2, False)
+    assert linkedin2username.parse_results('{"data": {}}') == SearchPage(False, 0)
+    assert linkedin2username.parse_results('<html>') == SearchPage(False, 0, error=True)
+
+
+def test_standin_end_to_end(tmp_path, monkeypatch):
+    standin = pytest.importorskip('benchmarks.standin')
+    fake = standin.StandIn(employees=2000, throttle=0.2, retry_after=0)
+    server = standin.serve(fake)
+    monkeypatch.setattr(linkedin2username, 'LINKEDIN_URL', server.url)
+    monkeypatch.setattr(linkedin2username.PageFetcher, 'pause', lambda self, seconds: self.closed.is_set())
+
+    session = linkedin2username.new_session(linkedin2username.STANDIN_COOKIES)
+    company_id, staff_count = linkedin2username.get_company_info('acme', session)
+    assert staff_count == 2000
+
+    args = argparse.Namespace(company='acme', domain='', output=str(tmp_path), formats=linkedin2username.DEFAULT_FORMATS,
+                              geoblast=False, keywords=['engineer', 'sales'], depth=41, sleep=0, rate=None,
+                              retries=10, prefetch=1, cache=None,
+                              profile=linkedin2username.RunProfile(str(tmp_path / 'run.prof')))
+    args.journal = linkedin2username.ScrapeJournal(tmp_path / 'journal.jsonl', {})
+    with args.profile.phase('scrape', cprofile=True):
+        written = linkedin2username.stream_files(session, company_id, range(2), args)
+    server.shutdown()
+
+    people = [person for person in fake.company('acme').people
+              if 'engineer' in person[1].lower() or 'sales' in person[1].lower()]
+    assert written == len(people)
+    assert fake.throttled
+    with open(tmp_path / 'acme-rawnames.txt', encoding='utf-8') as infile:
+        assert sorted(infile.read().splitlines()) == sorted(person[0] for person in people)
+
+    # Every request and page went in the profile
+    args.profile.write(tmp_path / 'profile.json')
+    with open(tmp_path / 'profile.json') as infile:
+        report = json.load(infile)
+    assert report['requests']['count'] == fake.searches
+    assert report['requests']['statuses']['429'] == fake.throttled
+    assert report['parse']['count'] == report['requests']['statuses']['200']
+    assert report['requests']['latency']['p50'] <= report['requests']['latency']['p99']
+    assert set(report['files']) >= {'acme-rawnames.txt', 'acme-first.last.txt'}
+    assert 'scrape' in report['phases']
+    assert os.path.getsize(tmp_path / 'run.prof')
+
+
+def test_session_store(tmp_path, monkeypatch):
+    store = linkedin2username.SessionStore(str(tmp_path / 'private' / 'session.json'))
+    assert store.load() is None
+
+    cookies = {'JSESSIONID': '"ajax:1234"', 'li_at': 'secret'}
+    store.save(cookies)
+    assert store.load() == cookies
+    assert os.stat(store.path).st_mode & 0o777 == 0o600
+    assert os.listdir(tmp_path / 'private') == ['session.json']
+    assert linkedin2username.SessionStore(store.path, fresh=True).load() is None
+
+    # A good saved session skips the browser, a bad one falls back to it
+    def browser():
+        raise AssertionError("the browser was started")
+    monkeypatch.setattr(linkedin2username, 'get_webdriver', browser)
+    monkeypatch.setattr(linkedin2username, 'LINKEDIN_URL', linkedin2username.LINKEDIN_DEFAULT_URL)
+    monkeypatch.setattr(linkedin2username, 'session_valid', lambda session, proxies: True)
+    session = linkedin2username.login(store)
+    assert session.headers['Csrf-Token'] == 'ajax:1234'
+    assert session.cookies['li_at'] == 'secret'
+
+    monkeypatch.setattr(linkedin2username, 'session_valid', lambda session, proxies: False)
+    with pytest.raises(AssertionError, match='browser'):
+        linkedin2username.login(store)
+
+    with open(store.path, 'w') as outfile:
+        outfile.write('{"cookies": ')
+    assert store.load() is None
+
+
+def test_session_valid(monkeypatch):
+    standin = pytest.importorskip('benchmarks.standin')
+    server = standin.serve(standin.StandIn(employees=0))
+    monkeypatch.setattr(linkedin2username, 'LINKEDIN_URL', server.url)
+
+    assert linkedin2username.session_valid(linkedin2username.new_session(linkedin2username.STANDIN_COOKIES))
+    assert not linkedin2username.session_valid(requests.Session())
+    server.shutdown()
+    monkeypatch.setattr(linkedin2username, 'LINKEDIN_URL', 'http://127.0.0.1:1')
+    assert not linkedin2username.session_valid(requests.Session())
+
+
+# Importing the module for names or offline work must stay cheap: no browser, no
+# HTTP stack, and a cold start in the low tens of milliseconds.
+IMPORT_BUDGET = 0.04
+LAZY_MODULES = {'dphelper', 'DrissionPage', 'requests', 'urllib3', 'concurrent', 'multiprocessing'}
+
+
+def imported_modules(module):
+    """Returns the top level modules importing module pulls in, in a new interpreter."""
+    command = [sys.executable, '-c', f'import sys, {module}; print(" ".join(sys.modules))']
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    return {name.split('.')[0] for name in result.stdout.split()}
+
+
+def test_import_time(tmp_path):
+    assert not imported_modules('linkedin2username') & LAZY_MODULES
+    assert not imported_modules('server') & {'dphelper', 'DrissionPage'}
+
+    # Bytecode is written on the first run and kept out of the tree, like an installed copy
+    env = {name: value for name, value in os.environ.items() if name != 'PYTHONDONTWRITEBYTECODE'}
+    command = [sys.executable, '-X', 'importtime', '-X', f'pycache_prefix={tmp_path}', '-c', 'import linkedin2username']
+    times = []
+    for _ in range(4):
+        result = subprocess.run(command, env=env, capture_output=True, text=True, check=True)
+        line = [line for line in result.stderr.splitlines() if line.endswith('| linkedin2username')][0]
+        times.append(int(line.split('|')[1]) / 1000000)
+    assert min(times[1:]) < IMPORT_BUDGET
@@ -0,0 +1,393 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+server = pytest.importorskip('server')
+standin = pytest.importorskip('benchmarks.standin')
+
+
+def metric(name):
+    """Returns the value of a sample from /metrics."""
+    response = asyncio.run(server.metrics())
+    for line in response.body.decode().splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[-1])
+    return 0
+
+
+async def call(method, path, body=None):
+    """Sends one request straight to the app, returning the status, headers and body."""
+    sent = [{'type': 'http.request', 'body': json.dumps(body).encode() if body else b'', 'more_body': False}]
+    messages = []
+
+    async def receive():
+        if sent:
+            return sent.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+             'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+             'headers': [(b'content-type', b'application/json')], 'server': ('test', 80), 'client': ('test', 1)}
+    await server.app(scope, receive, send)
+    headers = {name.decode(): value.decode() for name, value in messages[0]['headers']}
+    return messages[0]['status'], headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def test_metrics(monkeypatch):
+    fake = standin.StandIn(employees=120, throttle=0.3, retry_after=0)
+    linkedin = standin.serve(fake)
+    monkeypatch.setattr(server, 'LINKEDIN_URL', linkedin.url)
+
+    # Don't wait out the backoff after 429s
+    no_wait = asyncio.sleep
+    monkeypatch.setattr(server.asyncio, 'sleep', lambda seconds: no_wait(0))
+
+    pages, names = metric('li2u_pages_total'), metric('li2u_names_found_total')
+    searches = metric('li2u_call_seconds_count{function="get_results"}')
+
+    async def scrape():
+        async with server.new_session(server.STANDIN_COOKIES) as session:
+            company_id, staff_count = await server.get_company_info('acme', session)
+            request = server.CompanyRequest(company='acme', depth=5)
+            request.depth, request.geoblast = server.set_inner_loops(staff_count, request)
+            return await server.do_loops(session, company_id, server.set_outer_loops(request), request)
+
+    employees = asyncio.run(scrape())
+    linkedin.shutdown()
+
+    assert len(employees) == 120
+    assert metric('li2u_pages_total') - pages == 3
+    assert metric('li2u_names_found_total') - names == len(employees)
+    assert metric('li2u_call_seconds_count{function="get_results"}') - searches == fake.searches
+    assert metric('li2u_search_replies_total{status="429"}') >= fake.throttled
+    assert metric('li2u_search_retries_total') >= fake.throttled
+    assert metric('li2u_scrapes_in_progress') == 0
+    assert metric('li2u_parse_seconds_bucket{le="+Inf"}') == metric('li2u_parse_seconds_count')
+
+
+def test_connection_errors():
+    class DeadSession():
+        def get(self, url):
+            raise server.aiohttp.ClientConnectionError()
+
+    # A connection that keeps failing ends the search like an exhausted 5xx
+    replies = metric('li2u_search_replies_total{status="599"}')
+    timed, paced = metric('li2u_call_seconds_sum{function="get_results"}'), metric('li2u_search_paced_seconds_total')
+    pacer = server.RequestPacer(0.3, retries=1)
+    pacer.retry_delay = lambda status, retry_after, attempt: 0 if attempt < pacer.retries else None
+    result = asyncio.run(server.get_results(DeadSession(), '1234', 0, '', '', pacer))
+    assert result.status_code == 599
+    assert metric('li2u_search_replies_total{status="599"}') - replies == 2
+
+    # Only the requests are timed, waiting between them is counted on its own
+    assert metric('li2u_call_seconds_sum{function="get_results"}') - timed < 0.1
+    assert metric('li2u_search_paced_seconds_total') - paced >= 0.25
+
+
+def test_histogram_render():
+    histogram = server.Histogram('test_seconds', 'A test.', ('name',))
+    server.METRICS.remove(histogram)
+    histogram.observe(0.02, 'a"b')
+    histogram.observe(7, 'a"b')
+    lines = histogram.render().splitlines()
+    assert lines[:2] == ['# HELP test_seconds A test.', '# TYPE test_seconds histogram']
+    assert 'test_seconds_bucket{name="a\\"b",le="0.01"} 0' in lines
+    assert 'test_seconds_bucket{name="a\\"b",le="0.025"} 1' in lines
+    assert 'test_seconds_bucket{name="a\\"b",le="10"} 2' in lines
+    assert lines[-2:] == ['test_seconds_sum{name="a\\"b"} 7.02', 'test_seconds_count{name="a\\"b"} 2']
+
+
+def test_session_pool(monkeypatch, tmp_path):
+    linkedin = standin.serve(standin.StandIn(employees=0))
+    monkeypatch.setattr(server, 'LINKEDIN_URL', linkedin.url)
+    logins = []
+
+    async def browser_login():
+        logins.append(1)
+        return server.STANDIN_COOKIES
+    monkeypatch.setattr(server, 'login', browser_login)
+
+    async def borrow():
+        # The saved session is used without a browser, and sessions are reused
+        store = server.SessionStore(str(tmp_path / 'session.json'))
+        store.save(server.STANDIN_COOKIES)
+        pool = server.SessionPool(store, size=1)
+        await pool.warm()
+        async with pool.session() as first:
+            async with pool.session() as second:
+                assert second is not first
+        async with pool.session() as third:
+            assert third is second
+        assert first.closed and not logins
+
+        # Turned away sessions log in again, with the browser if the saved one is no good
+        with open(store.path, 'w') as outfile:
+            outfile.write('{}')
+        with pytest.raises(server.HTTPException):
+            async with pool.session() as session:
+                raise server.HTTPException(status_code=401)
+        assert session.closed and pool.cookies is None
+        async with pool.session() as session:
+            assert session.headers['Csrf-Token'] == 'ajax:standin'
+        assert logins == [1]
+        assert store.load() == server.STANDIN_COOKIES
+
+        # Cookies another scrape expires right after the login are not needed to borrow
+        login = pool.login
+
+        async def racing_login():
+            cookies = await login()
+            pool.cookies = None
+            return cookies
+        await pool.close()
+        pool.login, pool.cookies = racing_login, None
+        borrowed = await pool.acquire()
+        assert borrowed.headers['Csrf-Token'] == 'ajax:standin'
+        await borrowed.close()
+        del pool.login
+
+        # Sessions idle for long are checked with LinkedIn first
+        monkeypatch.setattr(server, 'SESSION_CHECK_SECONDS', 0)
+        linkedin.shutdown()
+        linkedin.server_close()
+        async with pool.session() as fresh:
+            assert fresh is not session
+        assert session.closed
+        await pool.close()
+        assert fresh.closed
+
+    asyncio.run(borrow())
+
+
+def test_scrape_endpoint(monkeypatch):
+    linkedin = standin.serve(standin.StandIn(employees=60))
+    monkeypatch.setattr(server, 'LINKEDIN_URL', linkedin.url)
+    monkeypatch.setenv('LI2U_CACHE_TTL', '0')
+    logins = metric('li2u_logins_total{source="browser"}')
+
+    async def scrape():
+        async with server.lifespan(server.app):
+            for _ in range(2):
+                tasks = server.BackgroundTasks()
+                result = await server.scrape_linkedin(server.CompanyRequest(company='acme'), tasks)
+                assert len(result.employees) == 60 and len(tasks.tasks) == 1
+        assert not server.app.state.sessions.idle
+
+    asyncio.run(scrape())
+    linkedin.shutdown()
+    assert metric('li2u_logins_total{source="browser"}') - logins == 1
+
+
+def test_response_cache(monkeypatch, tmp_path):
+    linkedin = standin.serve(standin.StandIn(employees=60))
+    monkeypatch.setattr(server, 'LINKEDIN_URL', linkedin.url)
+    monkeypatch.setenv('LI2U_CACHE_DIR', str(tmp_path / 'cache'))
+    hits = metric('li2u_search_cache_hits_total')
+
+    # Opened by the app rather than on import, and the second scrape is served from it
+    assert server.CACHE is None
+
+    async def scrape():
+        async with server.lifespan(server.app):
+            for _ in range(2):
+                result = await server.scrape_linkedin(server.CompanyRequest(company='acme'), server.BackgroundTasks())
+                assert len(result.employees) == 60
+        assert server.CACHE is None
+
+    asyncio.run(scrape())
+    linkedin.shutdown()
+    assert metric('li2u_search_cache_hits_total') - hits == 2
+    assert os.stat(tmp_path / 'cache').st_mode & 0o777 == 0o700
+
+
+def test_jobs(monkeypatch):
+    linkedin = standin.serve(standin.StandIn(employees=300, latency=0.02))
+    monkeypatch.setattr(server, 'LINKEDIN_URL', linkedin.url)
+    monkeypatch.setenv('LI2U_CACHE_TTL', '0')
+    monkeypatch.setattr(server, 'JOB_WORKERS', 1)
+    monkeypatch.setattr(server, 'JOB_QUEUE_SIZE', 1)
+
+    async def jobs():
+        async with server.lifespan(server.app):
+            status, _, body = await call('POST', '/jobs', {'company': 'acme'})
+            assert status == 202
+            first = json.loads(body)
+            assert first['status'] == 'queued' and first['names'] == 0
+            await asyncio.sleep(0)
+
+            # One job runs and one waits, there's no room for a third
+            status, _, body = await call('POST', '/jobs', {'company': 'acme'})
+            second = json.loads(body)['id']
+            status, headers, _ = await call('POST', '/jobs', {'company': 'acme'})
+            assert status == 503 and headers['retry-after'] == '60'
+            assert (await call('POST', '/jobs', {'company': 'acme', 'formats': ['{nope}']}))[0] == 400
+
+            # A cancelled job gives its place in the queue up straight away
+            status, _, body = await call('DELETE', f'/jobs/{second}')
+            assert json.loads(body)['status'] == 'cancelled' and not server.app.state.jobs.pending
+            status, _, body = await call('POST', '/jobs', {'company': 'acme'})
+            assert status == 202
+            second = json.loads(body)['id']
+
+            while (progress := json.loads((await call('GET', f'/jobs/{first["id"]}'))[2]))['page'] < 2:
+                await asyncio.sleep(0.01)
+            assert progress['status'] == 'running' and progress['loops'] == 1 and progress['names'] >= 50
+            assert (await call('GET', f'/jobs/{first["id"]}/results'))[0] == 409
+
+            # Cancelling keeps what was found so far
+            status, _, body = await call('DELETE', f'/jobs/{first["id"]}')
+            assert json.loads(body)['status'] == 'cancelled'
+            status, _, body = await call('GET', f'/jobs/{first["id"]}/results')
+            result = json.loads(body)
+            assert status == 200 and result['status'] == 'cancelled' and 50 <= len(result['employees']) < 300
+
+            while not app_job(second).finished:
+                await asyncio.sleep(0.01)
+            result = json.loads((await call('GET', f'/jobs/{second}/results'))[2])
+            assert result['status'] == 'done' and len(result['employees']) == 300
+            assert (await call('GET', '/jobs/nope'))[0] == 404
+
+    def app_job(job_id):
+        return server.app.state.jobs.jobs[job_id]
+
+    asyncio.run(jobs())
+    linkedin.shutdown()
+
+
+def test_stream_scrape(monkeypatch):
+    linkedin = standin.serve(standin.StandIn(employees=120))
+    monkeypatch.setattr(server, 'LINKEDIN_URL', linkedin.url)
+    monkeypatch.setenv('LI2U_CACHE_TTL', '0')
+
+    async def stream():
+        async with server.lifespan(server.app):
+            status, headers, body = await call('POST', '/scrape/stream?usernames=true',
+                                               {'company': 'acme', 'domain': 'acme.com', 'formats': ['{last}{first}']})
+            assert status == 200 and headers['content-type'] == 'application/x-ndjson'
+            lines = [json.loads(line) for line in body.decode().splitlines()]
+
+            status, headers, body = await call('POST', '/scrape/stream?format=sse', {'company': 'acme'})
+            assert status == 200 and headers['content-type'].startswith('text/event-stream')
+            events = body.decode().split('\n\n')
+
+            assert (await call('POST', '/scrape/stream?format=xml', {'company': 'acme'}))[0] == 400
+            return lines, events
+
+    lines, events = asyncio.run(stream())
+    linkedin.shutdown()
+
+    assert lines[-1] == {'names': 120}
+    assert len(lines) == 121
+    people = {person[:2] for person in standin.Company('acme', 120).people}
+    assert {(line['full_name'], line['occupation']) for line in lines[:-1]} == people
+    for line in lines[:-1]:
+        name = server.parse_name(line['full_name'])
+        if name:
+            assert f"{name['first']}.{name['last']}@acme.com" in line['usernames']['first.last']
+            assert f"{name['last']}{name['first']}@acme.com" in line['usernames']['lastfirst']
+        else:
+            assert all(not usernames for usernames in line['usernames'].values())
+
+    assert events[0].startswith('event: employee\ndata: {"full_name": ')
+    assert 'usernames' not in events[0]
+    assert events[-2] == 'event: done\ndata: {"names": 120}' and events[-1] == ''
+
+
+def test_stream_first_page(monkeypatch):
+    # Pages go out as they are parsed, not once the search is over
+    linkedin = standin.serve(standin.StandIn(employees=150, latency=0.2))
+    monkeypatch.setattr(server, 'LINKEDIN_URL', linkedin.url)
+    monkeypatch.setenv('LI2U_CACHE_TTL', '0')
+
+    async def stream():
+        async with server.lifespan(server.app):
+            response = await server.stream_scrape(server.CompanyRequest(company='acme'))
+            started = asyncio.get_running_loop().time()
+            times = []
+            async for chunk in response.body_iterator:
+                times.append(asyncio.get_running_loop().time() - started)
+            return times
+
+    times = asyncio.run(stream())
+    linkedin.shutdown()
+    assert len(times) == 4
+    assert times[0] < 0.4 < times[-1]
+
+
+@pytest.mark.parametrize('kind', ['zip', 'tar'])
+def test_job_archive(monkeypatch, tmp_path, kind):
+    import io
+    import tarfile
+    import zipfile
+
+    linkedin = standin.serve(standin.StandIn(employees=400))
+    monkeypatch.setattr(server, 'LINKEDIN_URL', linkedin.url)
+    monkeypatch.setenv('LI2U_CACHE_TTL', '0')
+
+    async def archive():
+        async with server.lifespan(server.app):
+            body = {'company': 'acme', 'domain': 'acme.com', 'formats': ['{last}_{f}']}
+            job_id = json.loads((await call('POST', '/jobs', body))[2])['id']
+            assert (await call('GET', f'/jobs/{job_id}/archive'))[0] == 409
+            job = server.app.state.jobs.jobs[job_id]
+            while not job.finished:
+                await asyncio.sleep(0.01)
+            assert (await call('GET', f'/jobs/{job_id}/archive?kind=rar'))[0] == 400
+            return job, await call('GET', f'/jobs/{job_id}/archive?kind={kind}')
+
+    job, (status, headers, body) = asyncio.run(archive())
+    linkedin.shutdown()
+    assert status == 200 and headers['content-disposition'] == f"attachment; filename*=UTF-8''acme.{kind}"
+
+    # Same files, byte for byte, as the CLI writes
+    server.write_files('acme', '@acme.com', job.employees, str(tmp_path), job.formats)
+    if kind == 'zip':
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            assert archive.testzip() is None
+            files = {name: archive.read(name) for name in archive.namelist()}
+    else:
+        assert len(body) % tarfile.RECORDSIZE == 0
+        with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+            files = {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+    assert sorted(files) == sorted(os.listdir(tmp_path))
+    assert 'acme-last_f.txt' in files
+    for name, data in files.items():
+        with open(tmp_path / name, 'rb') as infile:
+            assert data == infile.read()
+
+
+def test_session_expires_mid_scrape(monkeypatch):
+    fake = standin.StandIn(employees=300, expire_after=2)
+    linkedin = standin.serve(fake)
+    monkeypatch.setattr(server, 'LINKEDIN_URL', linkedin.url)
+    monkeypatch.setenv('LI2U_CACHE_TTL', '0')
+    logins = metric('li2u_logins_total{source="browser"}')
+
+    async def run(job):
+        app.state.jobs.submit(job)
+        while not job.finished:
+            await asyncio.sleep(0.01)
+        return job
+
+    async def jobs():
+        async with server.lifespan(app):
+            # LinkedIn turns the session away on the third page, keeping the first two
+            job = await run(server.Job(server.CompanyRequest(company='acme'), server.UsernameFormats.with_extra([])))
+            assert (job.status, job.page, job.names) == ('failed', 2, 100)
+            assert app.state.sessions.cookies is None and not app.state.sessions.idle
+
+            # The next job logs in again
+            fake.expire_after = None
+            job = await run(server.Job(server.CompanyRequest(company='acme'), server.UsernameFormats.with_extra([])))
+            assert (job.status, job.names) == ('done', 300)
+
+    app = server.app
+    asyncio.run(jobs())
+    linkedin.shutdown()
+    assert metric('li2u_logins_total{source="browser"}') - logins == 2